@@ -0,0 +1,265 @@
+import collections
+import logging
+import threading
+import time
+
+from django.db import models
+
+from .models import Car, Driver, FastLap, FastLapSegment, Game, SessionType, Track
+
+
+class IdentityCache:
+    """In-process identity map for the dimension tables.
+
+    Drivers, games, session types, cars and tracks are looked up over and
+    over again with the same keys. The cache returns the same model instance
+    for the same lookup, entries expire after `ttl` seconds and the least
+    recently used entries are dropped above `maxsize`. Saving or deleting an
+    instance invalidates all its entries (see telemetry.signals).
+
+    Args:
+        maxsize (int): maximum number of cached lookups
+        ttl (int): seconds until a cached lookup expires
+    """
+
+    # lookups used to preload a model
+    NATURAL_KEYS = {
+        Driver: ["name"],
+        Game: ["name"],
+        SessionType: ["type"],
+        Car: ["game", "name"],
+        Track: ["game", "name"],
+    }
+
+    def __init__(self, maxsize=4096, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        # (model label, pk) -> keys of the cached lookups of that instance
+        self._keys = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model, lookup):
+        items = []
+        for field, value in lookup.items():
+            if field == "id":
+                field = "pk"
+            if isinstance(value, models.Model):
+                value = value.pk
+            items.append((field, value))
+        return (model._meta.label, tuple(sorted(items)))
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            instance, expires = entry
+            if expires < time.monotonic():
+                self._remove(key, instance)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return instance
+
+    def _put(self, key, instance):
+        expires = time.monotonic() + self.ttl
+        pk_key = self._key(type(instance), {"pk": instance.pk})
+        with self._lock:
+            for k in [key, pk_key]:
+                old = self._entries.get(k)
+                if old is not None and old[0] is not instance:
+                    self._discard_key(k, old[0])
+                self._entries[k] = (instance, expires)
+                self._entries.move_to_end(k)
+                self._keys[(instance._meta.label, instance.pk)].add(k)
+            while len(self._entries) > self.maxsize:
+                k, (old, _) = self._entries.popitem(last=False)
+                self._discard_key(k, old)
+
+    def _discard_key(self, key, instance):
+        keys = self._keys.get((instance._meta.label, instance.pk))
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[(instance._meta.label, instance.pk)]
+
+    def _remove(self, key, instance):
+        self._entries.pop(key, None)
+        self._discard_key(key, instance)
+
+    def get(self, model, **lookup):
+        """Like model.objects.get(**lookup), raises model.DoesNotExist."""
+        key = self._key(model, lookup)
+        instance = self._get(key)
+        if instance is None:
+            instance = model.objects.get(**lookup)
+            self._put(key, instance)
+        return instance
+
+    def get_or_create(self, model, defaults=None, **lookup):
+        """Like model.objects.get_or_create(defaults=defaults, **lookup)."""
+        key = self._key(model, lookup)
+        instance = self._get(key)
+        if instance is not None:
+            return instance, False
+        instance, created = model.objects.get_or_create(defaults=defaults, **lookup)
+        self._put(key, instance)
+        return instance, created
+
+    def invalidate(self, instance):
+        """Drop all cached lookups of instance."""
+        with self._lock:
+            keys = self._keys.pop((instance._meta.label, instance.pk), set())
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def preload(self, *model_classes):
+        """Load all rows of the given models (default all dimension tables)."""
+        for model in model_classes or self.NATURAL_KEYS.keys():
+            count = 0
+            for instance in model.objects.all():
+                lookup = {
+                    field: getattr(instance, model._meta.get_field(field).attname)
+                    for field in self.NATURAL_KEYS[model]
+                }
+                self._put(self._key(model, lookup), instance)
+                count += 1
+            logging.debug(f"preloaded {count} {model._meta.verbose_name_plural}")
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class FastLapSnapshot:
+    """A fast lap with its segments as loaded at one version.
+
+    Snapshots are shared between coaches and must not be modified.
+    """
+
+    __slots__ = ("fast_lap", "segments", "version", "checked", "plans")
+
+    def __init__(self, fast_lap, segments):
+        self.fast_lap = fast_lap
+        self.segments = tuple(segments)
+        self.version = fast_lap.version
+        # monotonic time the version was last compared with the database
+        self.checked = time.monotonic()
+        # the coach message plans compiled from the snapshot, see pitcrew.message_plan
+        self.plans = {}
+
+    @property
+    def profile(self):
+        return self.fast_lap.profile
+
+
+class FastLapCache:
+    """Process-wide cache of fast lap snapshots.
+
+    Snapshots are keyed by (game, track, car, driver), the fast lap of all
+    drivers has driver None. Concurrent loads of the same key wait for the
+    first one. Every `check_interval` seconds the version of a cached fast
+    lap is compared with the database, so rewrites by other processes (e.g.
+    the analyze command) are picked up. Saves in this process invalidate the
+    snapshot right away (see telemetry.signals).
+
+    Args:
+        check_interval (int): seconds until the version is checked again
+    """
+
+    def __init__(self, check_interval=10):
+        self.check_interval = check_interval
+        self.loads = 0
+        self.hits = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._key_locks = collections.defaultdict(threading.Lock)
+
+    @staticmethod
+    def _key(game, track, car, driver):
+        return (game.pk, track.pk, car.pk, driver.pk if driver else None)
+
+    def get(self, game, track, car, driver=None):
+        """Return the snapshot of the fast lap, None if there is no fast lap of all drivers.
+
+        The fast lap of a driver is created if it does not exist yet.
+        """
+        key = self._key(game, track, car, driver)
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry.checked < self.check_interval:
+            self.hits += 1
+            return entry
+
+        with self._lock:
+            key_lock = self._key_locks[key]
+        with key_lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry.checked < self.check_interval:
+                self.hits += 1
+                return entry
+            if entry:
+                version = (
+                    FastLap.objects.filter(pk=entry.fast_lap.pk)
+                    .values_list("version", flat=True)
+                    .first()
+                )
+                if version == entry.version:
+                    entry.checked = time.monotonic()
+                    self.hits += 1
+                    return entry
+
+            entry = self._load(game, track, car, driver)
+            if entry:
+                self._entries[key] = entry
+            else:
+                self._entries.pop(key, None)
+            return entry
+
+    def _load(self, game, track, car, driver):
+        # the pickled data is only loaded if there is no profile_data
+        fast_laps = FastLap.objects.defer("data")
+        if driver:
+            fast_lap, created = fast_laps.get_or_create(
+                game=game, track=track, car=car, driver=driver
+            )
+        else:
+            fast_lap = fast_laps.filter(
+                game=game, track=track, car=car, driver=None
+            ).first()
+            if fast_lap is None:
+                return None
+        segments = FastLapSegment.objects.filter(fast_lap=fast_lap).order_by("turn")
+        entry = FastLapSnapshot(fast_lap, segments)
+        # build the distance / time tables once for all coaches
+        entry.profile
+        self.loads += 1
+        logging.debug(f"loaded fast lap {fast_lap} version {fast_lap.version}")
+        return entry
+
+    def invalidate(self, fast_lap_id):
+        """Drop the snapshots of a fast lap."""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.fast_lap.pk == fast_lap_id:
+                    self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "loads": self.loads}
+
+
+identity_cache = IdentityCache()
+fast_lap_cache = FastLapCache()
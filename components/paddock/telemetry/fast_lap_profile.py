@@ -0,0 +1,109 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+
+class FastLapProfile:
+    """Distance to lap time and lap time to distance tables of a fast lap.
+
+    Both directions are answered by linear interpolation in two sorted
+    arrays. Distances wrap around at the length of the lap and lap times
+    at the time of the lap, so offsets across the start/finish line work.
+
+    Profiles are stored in FastLap.profile_data as an uncompressed npz with
+    the lap time as a float32 column on a regular distance grid, see
+    to_bytes.
+
+    Args:
+        distance (array): distance into the lap in meters
+        lap_time (array): lap time in seconds at distance
+    """
+
+    # version of the stored format
+    FORMAT = 1
+
+    def __init__(self, distance, lap_time):
+        distance = np.asarray(distance, dtype=np.float64)
+        lap_time = np.asarray(lap_time, dtype=np.float64)
+        valid = ~(np.isnan(distance) | np.isnan(lap_time))
+        distance = distance[valid]
+        lap_time = lap_time[valid]
+
+        order = np.argsort(distance, kind="stable")
+        # the lap time must not decrease with the distance to be invertible
+        self._set_tables(distance[order], np.maximum.accumulate(lap_time[order]))
+
+    def _set_tables(self, distance, lap_time):
+        self.distance = distance
+        self.lap_time = lap_time
+        self.length = distance[-1]
+        self.time = lap_time[-1]
+        self._time_table = None
+
+    def __len__(self):
+        return len(self.distance)
+
+    @classmethod
+    def from_data(cls, data):
+        """Build the profile from the distance_time of FastLap.data, None if there is none."""
+        if not data:
+            return None
+        distance_time = data.get("distance_time")
+        if not isinstance(distance_time, pd.DataFrame) or distance_time.empty:
+            return None
+        return cls(
+            distance_time["DistanceRoundTrack"].to_numpy(),
+            distance_time["CurrentLapTime"].to_numpy(),
+        )
+
+    @classmethod
+    def from_bytes(cls, blob):
+        """Load a profile stored with to_bytes."""
+        with np.load(io.BytesIO(blob)) as npz:
+            version = int(npz["format"])
+            if version != cls.FORMAT:
+                raise ValueError(f"unknown fast lap profile format {version}")
+            start, step = npz["grid"]
+            lap_time = npz["lap_time"].astype(np.float64)
+        # stored profiles are sorted already, np.interp works on float64
+        profile = cls.__new__(cls)
+        profile._set_tables(start + step * np.arange(len(lap_time)), lap_time)
+        return profile
+
+    def to_bytes(self, step=1.0):
+        """Return the profile resampled to a grid of step meters as npz bytes."""
+        start = np.floor(self.distance[0])
+        distance = np.arange(start, self.length + step / 2, step)
+        lap_time = np.interp(distance, self.distance, self.lap_time)
+        blob = io.BytesIO()
+        np.savez(
+            blob,
+            format=np.int32(self.FORMAT),
+            grid=np.array([start, step]),
+            lap_time=lap_time.astype(np.float32),
+        )
+        return blob.getvalue()
+
+    def time_table(self):
+        """Return the lap time at every full meter of the lap as a list, computed once."""
+        if self._time_table is None:
+            meters = np.arange(int(self.length) + 2)
+            self._time_table = np.interp(meters, self.distance, self.lap_time).tolist()
+        return self._time_table
+
+    def time_at(self, distance):
+        """Return the lap time at distance."""
+        if self.length > 0:
+            distance = np.mod(distance, self.length)
+        return np.interp(distance, self.distance, self.lap_time)
+
+    def distance_at(self, lap_time):
+        """Return the distance at lap_time."""
+        if self.time > 0:
+            lap_time = np.mod(lap_time, self.time)
+        return np.interp(lap_time, self.lap_time, self.distance)
+
+    def offset_distance(self, distance, seconds=0.0):
+        """Return where the fast lap was seconds before it reached distance."""
+        return self.distance_at(self.time_at(distance) - seconds)
@@ -2,11 +2,13 @@ import csv
 import os
 import statistics
 from django.core.management.base import BaseCommand
+from telemetry.cache import identity_cache
 from telemetry.models import Game, Driver, Car, Track, SessionType, Lap, FastLap
 from telemetry.influx import Influx
 from telemetry.fast_lap_analyzer import FastLapAnalyzer
+from telemetry.fast_lap_profile import FastLapProfile
 import logging
-from django.db import connection
+from django.db import connection, transaction
 
 
 class Command(BaseCommand):
@@ -116,6 +118,7 @@ class Command(BaseCommand):
             )
 
     def handle(self, *args, **options):
+        identity_cache.preload()
         influx = Influx()
         influx_fast_sessions = set()
         if options["copy_influx"]:
@@ -160,7 +163,7 @@ class Command(BaseCommand):
         where = []
         filter_game = None
         if options["game"]:
-            filter_game = Game.objects.get(name=options["game"])
+            filter_game = identity_cache.get(Game, name=options["game"])
         if options["track"]:
             track = Track.objects.get(name=options["track"])
             where.append(f" track_id={track.pk}")
@@ -184,10 +187,10 @@ class Command(BaseCommand):
             rows = cursor.fetchall()
 
         for count, track_id, car_id in rows:
-            car = Car.objects.get(id=car_id)
-            track = Track.objects.get(id=track_id)
-            game = car.game
-            if filter_game and filter_game != car.game:
+            car = identity_cache.get(Car, pk=car_id)
+            track = identity_cache.get(Track, pk=track_id)
+            game = identity_cache.get(Game, pk=car.game_id)
+            if filter_game and filter_game != game:
                 continue
 
             if options["new"]:
@@ -287,25 +290,32 @@ class Command(BaseCommand):
         logging.debug(f"created: {created}, fast_lap: {fast_lap}")
 
     def save_fastlap(self, track_info, data, car=None, track=None, game=None):
-        fast_lap, created = FastLap.objects.get_or_create(
-            car=car, track=track, game=game, driver=None
-        )
-        fast_lap.data = data
-        fast_lap.save()
-        fast_lap.fast_lap_segments.all().delete()
-        i = 1
-        for brakepoint in track_info:
-            brakepoint["turn"] = i
-            print(brakepoint)
-            fast_lap.fast_lap_segments.create(**brakepoint)
-            i += 1
-        # also delete user segments
-        # FIXME only delete user segements if they changed?
-        r = (
-            FastLap.objects.filter(car=car, track=track, game=game)
-            .exclude(driver=None)
-            .delete()
-        )
+        # coaches reload the fast lap when they notice the new version
+        with transaction.atomic():
+            fast_lap, created = FastLap.objects.get_or_create(
+                car=car, track=track, game=game, driver=None
+            )
+            # the distance_time is stored as compact profile, not pickled
+            profile = FastLapProfile.from_data(data)
+            fast_lap.profile_data = profile.to_bytes() if profile else None
+            data = {key: value for key, value in data.items() if key != "distance_time"}
+            fast_lap.data = data or None
+            fast_lap.version += 1
+            fast_lap.save()
+            fast_lap.fast_lap_segments.all().delete()
+            i = 1
+            for brakepoint in track_info:
+                brakepoint["turn"] = i
+                print(brakepoint)
+                fast_lap.fast_lap_segments.create(**brakepoint)
+                i += 1
+            # also delete user segments
+            # FIXME only delete user segements if they changed?
+            r = (
+                FastLap.objects.filter(car=car, track=track, game=game)
+                .exclude(driver=None)
+                .delete()
+            )
         logging.debug(f"deleted {r} user segments")
 
     def handle_influx(self, *args, **options):
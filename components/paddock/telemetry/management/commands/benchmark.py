@@ -0,0 +1,125 @@
+import time
+from types import SimpleNamespace
+from django.core.management.base import BaseCommand
+from telemetry.pitcrew.clock import TelemetryClock
+from telemetry.pitcrew.coach import Coach
+from telemetry.pitcrew.history import History
+from telemetry.pitcrew.message_plan import MessagePlanBuilder
+from telemetry.pitcrew.session import Session
+
+
+class Command(BaseCommand):
+    help = "micro benchmarks for the pitcrew hot paths"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--session",
+            action="store_true",
+            help="benchmark the lap detection of Session.signal",
+        )
+        parser.add_argument(
+            "--coach",
+            action="store_true",
+            help="benchmark the message lookup of Coach.get_response",
+        )
+        parser.add_argument(
+            "--messages",
+            type=str,
+            default="10,100,500,1000",
+            help="comma separated numbers of messages per lap for --coach",
+        )
+        parser.add_argument(
+            "--sessions",
+            type=int,
+            default=100,
+            help="number of concurrent sessions",
+        )
+        parser.add_argument(
+            "--laps",
+            type=int,
+            default=3,
+            help="number of laps per session",
+        )
+        parser.add_argument(
+            "--track-length",
+            type=int,
+            default=4000,
+            help="track length in meters",
+        )
+
+    def lap_telemetry(self, laps, track_length, hz=60, speed=50):
+        """Generate the telemetry of a car driving laps at constant speed."""
+        step = speed / hz
+        ticks = []
+        timestamp = time.time() * 1000
+        for lap in range(laps):
+            distance = 0.0
+            while distance < track_length:
+                telemetry = {
+                    "DistanceRoundTrack": distance,
+                    "SpeedMs": speed,
+                    "Gear": 4,
+                    "Throttle": 1.0,
+                    "Brake": 0.0,
+                    "CurrentLapTime": distance / speed,
+                    "CurrentLap": lap + 1,
+                }
+                ticks.append((timestamp, telemetry))
+                distance += step
+                timestamp += 1000 / hz
+        return ticks
+
+    def benchmark_session(self, options):
+        ticks = self.lap_telemetry(options["laps"], options["track_length"])
+        clock = TelemetryClock()
+        sessions = []
+        for i in range(options["sessions"]):
+            session = Session(f"crewchief/driver{i}/1/game/track/car/race", clock)
+            session.session_id = str(i)
+            sessions.append(session)
+
+        start = time.perf_counter()
+        for timestamp, telemetry in ticks:
+            for session in sessions:
+                session.signal(telemetry, timestamp)
+        elapsed = time.perf_counter() - start
+
+        count = len(ticks) * len(sessions)
+        self.stdout.write(
+            f"Session.signal: {count} ticks in {elapsed:.2f}s"
+            + f" - {count / elapsed:.0f} ticks/s"
+            + f" - {len(ticks) / elapsed:.1f} ticks/s per session"
+        )
+
+    def benchmark_coach(self, options):
+        track_length = options["track_length"]
+        ticks = self.lap_telemetry(options["laps"], track_length)
+        for count in [int(c) for c in options["messages"].split(",")]:
+            history = History()
+            history.ready = True
+            history.track_length = track_length
+            db_coach = SimpleNamespace(driver=SimpleNamespace(name="benchmark"))
+            coach = Coach(history, db_coach)
+            builder = MessagePlanBuilder(track_length)
+            for i in range(count):
+                builder.new_msg(i * track_length // count, "brake", None)
+            coach.set_plan(builder.build())
+
+            responses = 0
+            start = time.perf_counter()
+            for timestamp, telemetry in ticks:
+                if coach.get_response(telemetry):
+                    responses += 1
+            elapsed = time.perf_counter() - start
+
+            self.stdout.write(
+                f"Coach.get_response: {count} messages per lap"
+                + f" - {elapsed / len(ticks) * 1e6:.1f}us per tick"
+                + f" - {responses} responses"
+            )
+
+    def handle(self, *args, **options):
+        if options["session"]:
+            self.benchmark_session(options)
+        if options["coach"]:
+            self.benchmark_coach(options)
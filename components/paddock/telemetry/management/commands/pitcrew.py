@@ -2,7 +2,7 @@ from django.core.management.base import BaseCommand
 from telemetry.models import Coach, Driver, FastLap
 from telemetry.pitcrew.crew import Crew
 
-from flask import Flask
+from flask import Flask, Response
 from flask_healthz import healthz
 
 import threading
@@ -28,9 +28,15 @@ class Command(BaseCommand):
         if options["coach"]:
             driver = Driver.objects.get(name=options["coach"])
             coach, created = Coach.objects.get_or_create(driver=driver)
-            crew.coach_watcher.start_coach(
-                driver.name, coach, debug=True, replay=options["replay"]
-            )
+            crew.coach_watcher.start_coach(driver.name, coach, debug=True)
+            crew.firehose.driver = driver.name
+            crew.coach_dispatcher.start_workers()
+            t = threading.Thread(target=crew.firehose.run)
+            t.name = "firehose"
+            t.start()
+            t = threading.Thread(target=crew.coach_dispatcher.run)
+            t.name = "coach_dispatcher"
+            t.start()
         elif options["session_saver"]:
             t = threading.Thread(target=crew.firehose.run)
             t.name = "firehose"
@@ -39,12 +45,19 @@ class Command(BaseCommand):
             t.name = "session_saver"
             t.start()
         else:
+            # coach worker processes are forked before any other thread is started
+            crew.coach_dispatcher.start_workers()
             if not crew.replay and not options["no_save"]:
 
                 def start_flask():
                     app = Flask(__name__)
                     app.register_blueprint(healthz, url_prefix="/healthz")
                     app.config["HEALTHZ"] = {"live": crew.live, "ready": crew.ready}
+                    app.add_url_rule(
+                        "/metrics",
+                        "metrics",
+                        lambda: Response(crew.metrics(), mimetype="text/plain"),
+                    )
                     app.run(host="0.0.0.0", port=8080, debug=False, use_reloader=False)
 
                 flask_thread = threading.Thread(target=start_flask)
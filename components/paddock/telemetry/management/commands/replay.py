@@ -14,6 +14,10 @@ B4MAD_RACING_CLIENT_USER = os.environ.get("B4MAD_RACING_CLIENT_USER", "crewchief
 B4MAD_RACING_CLIENT_PASSWORD = os.environ.get(
     "B4MAD_RACING_CLIENT_PASSWORD", "crewchief"
 )
+B4MAD_RACING_MQTT_HOST = os.environ.get(
+    "B4MAD_RACING_MQTT_HOST", "telemetry.b4mad.racing"
+)
+B4MAD_RACING_MQTT_PORT = int(os.environ.get("B4MAD_RACING_MQTT_PORT", 31883))
 
 
 class Command(BaseCommand):
@@ -110,8 +114,8 @@ class Command(BaseCommand):
     def replay(self, session, wait=0.001, new_session_id=None):
         mqttc = mqtt.Client()
         mqttc.username_pw_set(B4MAD_RACING_CLIENT_USER, B4MAD_RACING_CLIENT_PASSWORD)
-        mqttc.connect("telemetry.b4mad.racing", 31883, 60)
-        logging.info("Connected to telemetry.b4mad.racing")
+        mqttc.connect(B4MAD_RACING_MQTT_HOST, B4MAD_RACING_MQTT_PORT, 60)
+        logging.info(f"Connected to {B4MAD_RACING_MQTT_HOST}")
         # epoch = datetime.datetime.utcfromtimestamp(0)
 
         prev_payload = {"telemetry": {}}
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("telemetry", "0005_fastlap_data"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="fastlap",
+            name="version",
+            field=models.IntegerField(default=0),
+        ),
+    ]
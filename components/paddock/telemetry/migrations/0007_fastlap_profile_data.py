@@ -0,0 +1,71 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:31
+
+import io
+
+import numpy as np
+import pandas as pd
+from django.db import migrations, models
+
+# the stored profile format 1 of FastLapProfile, frozen for this migration
+PROFILE_FORMAT = 1
+
+
+def profile_bytes(distance_time, step=1.0):
+    """Return the distance_time of FastLap.data as profile bytes, None if there is none."""
+    if not isinstance(distance_time, pd.DataFrame) or distance_time.empty:
+        return None
+    distance = distance_time["DistanceRoundTrack"].to_numpy(dtype=np.float64)
+    lap_time = distance_time["CurrentLapTime"].to_numpy(dtype=np.float64)
+    valid = ~(np.isnan(distance) | np.isnan(lap_time))
+    distance = distance[valid]
+    lap_time = lap_time[valid]
+    if not len(distance):
+        return None
+
+    order = np.argsort(distance, kind="stable")
+    distance = distance[order]
+    lap_time = np.maximum.accumulate(lap_time[order])
+
+    start = np.floor(distance[0])
+    grid = np.arange(start, distance[-1] + step / 2, step)
+    blob = io.BytesIO()
+    np.savez(
+        blob,
+        format=np.int32(PROFILE_FORMAT),
+        grid=np.array([start, step]),
+        lap_time=np.interp(grid, distance, lap_time).astype(np.float32),
+    )
+    return blob.getvalue()
+
+
+def convert_profiles(apps, schema_editor):
+    """Store the distance_time of the pickled data as compact profile and drop it from the data."""
+    FastLap = apps.get_model("telemetry", "FastLap")
+    for fast_lap in FastLap.objects.filter(data__isnull=False).iterator():
+        if not fast_lap.data:
+            continue
+        profile_data = profile_bytes(fast_lap.data.get("distance_time"))
+        if profile_data is not None:
+            fast_lap.profile_data = profile_data
+            data = {
+                key: value
+                for key, value in fast_lap.data.items()
+                if key != "distance_time"
+            }
+            fast_lap.data = data or None
+            fast_lap.save(update_fields=["profile_data", "data"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("telemetry", "0006_fastlap_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="fastlap",
+            name="profile_data",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(convert_profiles, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,11 @@
 from django.db import models
+from django.utils.functional import cached_property
 from dirtyfields import DirtyFieldsMixin
 from picklefield.fields import PickledObjectField
 import datetime
 
+from .fast_lap_profile import FastLapProfile
+
 
 class Driver(models.Model):
     name = models.CharField(max_length=200, unique=True)
@@ -102,10 +105,21 @@ class FastLap(models.Model):
     )
     # add binary field to hold arbitrary data
     data = PickledObjectField(null=True)
+    # the FastLapProfile in its compact binary format
+    profile_data = models.BinaryField(null=True)
+    # incremented whenever data or the segments are rewritten
+    version = models.IntegerField(default=0)
 
     def __str__(self):
         return f"{self.game} {self.car} {self.track}"
 
+    @cached_property
+    def profile(self):
+        """The FastLapProfile of profile_data, falls back to the distance_time in data."""
+        if self.profile_data:
+            return FastLapProfile.from_bytes(bytes(self.profile_data))
+        return FastLapProfile.from_data(self.data)
+
 
 class FastLapSegment(models.Model):
     turn = models.CharField(max_length=200)
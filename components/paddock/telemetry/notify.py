@@ -0,0 +1,106 @@
+import collections
+import logging
+import select
+import threading
+from queue import Empty, SimpleQueue
+
+from django.db import connection, transaction
+
+COACH_CHANNEL = "telemetry_coach"
+
+
+class LocalListener:
+    """Receives the notifications sent by this process."""
+
+    def __init__(self, notifier, channel):
+        self.notifier = notifier
+        self.channel = channel
+        self.queue = SimpleQueue()
+
+    def get(self, timeout=1.0):
+        """Return the pending payloads, waits up to timeout seconds for the first one."""
+        try:
+            payloads = [self.queue.get(timeout=timeout)]
+        except Empty:
+            return []
+        while True:
+            try:
+                payloads.append(self.queue.get_nowait())
+            except Empty:
+                return payloads
+
+    def close(self):
+        self.notifier.unlisten(self)
+
+
+class PostgresListener:
+    """Receives the notifications of a PostgreSQL channel on its own connection."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.conn = connection.get_new_connection(connection.get_connection_params())
+        self.conn.autocommit = True
+        with self.conn.cursor() as cursor:
+            cursor.execute(f'LISTEN "{channel}"')
+
+    def get(self, timeout=1.0):
+        """Return the pending payloads, waits up to timeout seconds for the first one."""
+        if not self.conn.notifies:
+            if select.select([self.conn], [], [], timeout) == ([], [], []):
+                return []
+        self.conn.poll()
+        payloads = [notify.payload for notify in self.conn.notifies]
+        self.conn.notifies.clear()
+        return payloads
+
+    def close(self):
+        self.conn.close()
+
+
+class Notifier:
+    """Change notifications between the web and the pitcrew processes.
+
+    On PostgreSQL the notifications are sent with NOTIFY and received with
+    LISTEN, so they reach every process. Other databases (e.g. sqlite in
+    development and tests) only reach the listeners of the same process.
+    Notifications are sent when the current transaction commits.
+    """
+
+    def __init__(self):
+        self._listeners = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def postgres():
+        return connection.vendor == "postgresql"
+
+    def notify(self, channel, payload):
+        if self.postgres():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_notify(%s, %s)", [channel, payload])
+        else:
+            transaction.on_commit(lambda: self._notify_local(channel, payload))
+
+    def _notify_local(self, channel, payload):
+        with self._lock:
+            listeners = list(self._listeners[channel])
+        for listener in listeners:
+            listener.queue.put(payload)
+
+    def listen(self, channel):
+        """Return a listener receiving the notifications of channel."""
+        if self.postgres():
+            logging.debug(f"listening to postgres channel {channel}")
+            return PostgresListener(channel)
+        listener = LocalListener(self, channel)
+        with self._lock:
+            self._listeners[channel].append(listener)
+        return listener
+
+    def unlisten(self, listener):
+        with self._lock:
+            if listener in self._listeners[listener.channel]:
+                self._listeners[listener.channel].remove(listener)
+
+
+notifier = Notifier()
@@ -0,0 +1,110 @@
+import collections
+import threading
+import time
+
+
+class _Forced:
+    """A queued item which is never dropped."""
+
+    __slots__ = ("item",)
+
+    def __init__(self, item):
+        self.item = item
+
+
+class BatchQueue:
+    """A bounded queue which is drained in batches.
+
+    The producer never waits unless the policy is "block", when the queue is
+    full either the oldest queued item or the new item is dropped. Forced
+    items, e.g. commands which have to run in order with the other items,
+    are queued even if the queue is full and are never dropped.
+
+    Args:
+        maxsize (int): maximum number of queued items
+        policy (str): overflow policy, one of "drop_oldest", "drop_newest", "block"
+    """
+
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    BLOCK = "block"
+    POLICIES = [DROP_OLDEST, DROP_NEWEST, BLOCK]
+
+    def __init__(self, maxsize=10000, policy=DROP_OLDEST):
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown overflow policy {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.max_depth = 0
+        self._items = collections.deque()
+        # number of queued forced items
+        self._forced = 0
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item, timeout=None, force=False):
+        """Queue an item, returns False if the item was dropped."""
+        with self._cond:
+            if force:
+                item = _Forced(item)
+                self._forced += 1
+            elif len(self._items) >= self.maxsize:
+                if self.policy == self.DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.policy == self.DROP_OLDEST:
+                    self._drop_oldest()
+                else:
+                    deadline = None if timeout is None else time.monotonic() + timeout
+                    while len(self._items) >= self.maxsize:
+                        remaining = None
+                        if deadline is not None:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                self.dropped += 1
+                                return False
+                        self._cond.wait(remaining)
+            self._items.append(item)
+            depth = len(self._items)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            self._cond.notify_all()
+        return True
+
+    def _drop_oldest(self):
+        items = self._items
+        if not self._forced:
+            items.popleft()
+            self.dropped += 1
+            return
+        for i, item in enumerate(items):
+            if type(item) is not _Forced:
+                del items[i]
+                self.dropped += 1
+                return
+
+    def get_batch(self, max_items=100, timeout=1.0):
+        """Return up to max_items items, waits up to timeout seconds for the first one."""
+        with self._cond:
+            if not self._items:
+                self._cond.wait(timeout)
+            batch = []
+            while self._items and len(batch) < max_items:
+                item = self._items.popleft()
+                if self._forced and type(item) is _Forced:
+                    item = item.item
+                    self._forced -= 1
+                batch.append(item)
+            if batch and self.policy == self.BLOCK:
+                self._cond.notify_all()
+        return batch
+
+    def stats(self):
+        return {
+            "depth": len(self._items),
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+        }
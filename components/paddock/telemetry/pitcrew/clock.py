@@ -0,0 +1,26 @@
+import datetime
+import django.utils.timezone
+
+
+class WallClock:
+    """The server time, the telemetry timestamp is ignored."""
+
+    def now(self, timestamp=None):
+        return django.utils.timezone.now()
+
+
+class TelemetryClock:
+    """The time the client sampled the telemetry.
+
+    Uses the `time` field of the payload (milliseconds since the epoch), which
+    makes lap times independent of broker and queue latency and lets recorded
+    sessions be processed faster than real time. Falls back to the server time
+    for payloads without a timestamp.
+    """
+
+    def now(self, timestamp=None):
+        if timestamp is None:
+            return django.utils.timezone.now()
+        return datetime.datetime.fromtimestamp(
+            timestamp / 1000, tz=datetime.timezone.utc
+        )
@@ -3,7 +3,10 @@
 import json
 import logging
 import time
+from .delta import B4MAD_RACING_DELTA_RATE, LapDelta
 from .history import History
+from .message_plan import MessagePlanBuilder, get_plan
+from .metrics import DELTA, HISTORY, LOOKUP, metrics
 from telemetry.models import Coach as DbCoach
 
 _LOGGER = logging.getLogger(__name__)
@@ -18,10 +21,23 @@ class Coach:
             "msg": {},
             "turn": None,
         }
-        self.messages = {}
+        # the shared MessagePlan of the fast lap, see set_plan
+        self.plan = None
+        self.cursor = None
+        # distance -> time the message was read
+        self.read = {}
+        # distances of the disabled messages
+        self.disabled = set()
+        # the LapDelta to the fast lap, None without a fast lap profile
+        self.delta = None
+        self.delta_interval = 0
+        if B4MAD_RACING_DELTA_RATE > 0:
+            self.delta_interval = 1 / B4MAD_RACING_DELTA_RATE
+        self._next_delta = 0
         self.debug = debug
         self.debug_data = {}
-        self.json_response = db_coach.driver.name == "durandom"
+        self.driver_name = db_coach.driver.name
+        self.json_response = self.driver_name == "durandom"
 
         self.msg_read_interval = 20
         if self.debug:
@@ -29,7 +45,14 @@ class Coach:
 
     def set_filter(self, filter):
         self.history.set_filter(filter)
-        self.messages = {}
+        self.plan = None
+        self.delta = None
+
+    def set_plan(self, plan):
+        self.plan = plan
+        self.cursor = plan.cursor()
+        self.read = {}
+        self.disabled = set()
 
     def get_response(self, telemetry):
         if not self.history.ready:
@@ -42,77 +65,63 @@ class Coach:
                 return None
         # _LOGGER.debug(f"meters: {meters}, msg: {self.msg}")
 
-        # build self.messages from fast laps segments
-        if not self.messages:
+        # get the messages of the fast laps segments
+        if self.plan is None:
             self.init_messages()
             # self.init_messages_debug()
-            for at in self.messages:
-                logging.debug(f"at {at}: {self.messages[at]['msg']}")
+            for at, message in self.plan.messages.items():
+                logging.debug(f"at {at}: {message.msg}")
 
         now = time.time()
-        # loop over all messages and check the distance, if we have something to say
-        distance_round_track = telemetry["DistanceRoundTrack"]
+        start = time.perf_counter()
         self.history.update(now, telemetry)
-        for at in self.messages:
-            distance = abs(at - distance_round_track)
-            # only read every 20 seconds and if we are close
-            msg = self.messages[at]
-            if "enabled" in msg and not msg["enabled"]:
+        lookup = time.perf_counter()
+        metrics.observe(HISTORY, lookup - start, self.driver_name)
+        if self.delta:
+            self.delta.update(
+                telemetry["DistanceRoundTrack"], telemetry["CurrentLapTime"]
+            )
+            start = lookup
+            lookup = time.perf_counter()
+            metrics.observe(DELTA, lookup - start, self.driver_name)
+        response = self.next_response(now, telemetry)
+        metrics.observe(LOOKUP, time.perf_counter() - lookup, self.driver_name)
+        return response
+
+    def next_response(self, now, telemetry):
+        # check the messages we got to since the last tick, if we have something to say
+        distance_round_track = telemetry["DistanceRoundTrack"]
+        for at in self.cursor.due(distance_round_track, telemetry["SpeedMs"]):
+            if at in self.disabled:
                 continue
-            if distance <= 1 and now - msg["read"] > self.msg_read_interval:
-                msg = self.messages[at]["msg"]
-                if callable(msg):
-                    self.messages[at]["read"] = now
-                    kwargs = self.messages[at]["kwargs"].copy()
+            # only read every 20 seconds
+            if now - self.read.get(at, 0) > self.msg_read_interval:
+                self.read[at] = now
+                message = self.plan.messages[at]
+                if message.fn:
+                    kwargs = message.kwargs.copy()
                     kwargs["telemetry"] = telemetry
                     kwargs["at"] = at
-                    message = msg(*self.messages[at]["args"], **kwargs)
-                    if message:
-                        return message
-                elif isinstance(msg, dict):
-                    self.messages[at]["read"] = now
-                    return json.dumps(msg)
+                    response = getattr(self, message.fn)(*message.args, **kwargs)
+                    if response:
+                        return response
                 else:
-                    self.messages[at]["read"] = now
-                    return msg
+                    return message.payload
 
     def init_messages(self):
         self.track_length = self.history.track.length
-        for segment in self.history.segments:
-            if segment.mark == "brake":
-                gear = ""
-                if segment.gear:
-                    gear = f"gear {segment.gear} "
-                text = gear + "%s percent" % (round(segment.force / 10) * 10)
-                at = segment.start
-                self.new_msg_done_by(at, text, segment)
-
-                at = segment.start
-                text = "brake"
-                msg = self.schedule_msg(at, text, segment)
-                # msg = self.new_msg(at, text, segment)
-
-                at = segment.end + 20
-                self.new_fn(at, self.eval_brake, segment, brake_msg_at=msg["at"])
-
-            if segment.mark == "throttle":
-                at = segment.start - 100
-                to = round(segment.force / 10) * 10
-                text = "throttle to %s" % to
-                self.new_msg_done_by(at, text, segment)
-
-                at = segment.start
-                text = "now"
-                self.schedule_msg(at, text, segment)
-                # self.new_msg(at, text, segment)
-
-            # if segment.gear:
-            #     at = segment.start - 80
-            #     text = f"gear {segment.gear}"
-            #     self.new_msg(at, text, segment)
-
-            #     at = segment.end + 60
-            #     self.new_fn(at, self.eval_gear, segment)
+        snapshot = self.history.snapshot
+        plan = get_plan(snapshot, self.track_length, self.json_response)
+        self.set_plan(plan)
+        if snapshot.profile is not None:
+            self.delta = LapDelta(snapshot.profile, snapshot.segments)
+
+    def delta_response(self, now):
+        """Return the delta to the fast lap if it is due, at most delta_interval seconds apart."""
+        if not self.delta or not self.delta_interval or now < self._next_delta:
+            return None
+        self._next_delta = now + self.delta_interval
+        return json.dumps(self.delta.to_dict()).encode()
 
     def eval_gear(self, segment, **kwargs):
         pass
@@ -178,71 +187,17 @@ class Coach:
 
     def enable_msg(self, segment, enabled=True):
         # iterate over messages and enable the one for this segment
-        for at in self.messages:
-            msg = self.messages[at]
-            if "segment" in msg and "enabled" in msg:
-                if msg["segment"] == segment:
-                    if isinstance(msg["msg"], str):
-                        if msg["enabled"] != enabled:
-                            msg["enabled"] = enabled
-                            logging.debug(f"at {at}: {msg['msg']} enabled: {enabled}")
-
-    def msg_read_time(self, msg):
-        # count the number of words
-        words = len(msg.split(" "))
-        return words * 0.8  # avg ms per word
-
-    def new_msg(self, at, msg, segment, finish_reading_at=False):
-        message = {
-            "msg": msg,
-            "read": 0,
-            "enabled": True,
-            "segment": segment,
-            "at": at,
-        }
-        at = at % self.history.track_length
-
-        # there's a delay of x seconds to read the message at the requested meters
-        # offset = 1.0  # time_delta 0.1
-        offset = 1.1
-        offset = 0
-
-        # if the message should be finished at the requested meters
-        if finish_reading_at:
-            read_time = self.msg_read_time(msg)
-            offset += read_time
-
-        if offset:
-            new_at = self.history.offset_distance(at, seconds=offset)
-            logging.debug(f"offset {offset:.2f} seconds: {at} -> {new_at}")
-            at = new_at
-        while at in self.messages:
-            at += 1
-            at = at % self.history.track_length
-        self.messages[at] = message
-        message["at"] = at
-        return message
-
-    def new_msg_done_by(self, at, msg, segment):
-        return self.new_msg(at, msg, segment, finish_reading_at=True)
-
-    def schedule_msg(self, at, msg, segment):
-        if self.json_response:
-            respond_at = at - 50
-            payload = {
-                "message": msg,
-                "distance": at,
-                "priority": 9,
-            }
-            return self.new_msg(respond_at, payload, segment)
-        else:
-            return self.new_msg(at, msg, segment)
-
-    def new_fn(self, at, fn, segment, **kwargs):
-        message = self.new_msg(at, fn, segment)
-        message["args"] = [segment]
-        message["kwargs"] = kwargs
-        return message
+        if self.plan is None:
+            return
+        for at, msg in self.plan.messages.items():
+            if msg.segment == segment and msg.fn is None:
+                if isinstance(msg.msg, str):
+                    if (at not in self.disabled) != enabled:
+                        if enabled:
+                            self.disabled.discard(at)
+                        else:
+                            self.disabled.add(at)
+                        logging.debug(f"at {at}: {msg.msg} enabled: {enabled}")
 
     # debug stuff
     def brake_debug(self, segment, **kwargs):
@@ -286,14 +241,15 @@ class Coach:
     def init_messages_debug(self):
         self.track_length = self.history.track.length
         self.brake_debug_time = 0
+        builder = MessagePlanBuilder(self.track_length)
         # for at in range(0, self.track_length, 500):
-        #     self.new_msg(at, "brake", None)
+        #     builder.new_msg(at, "brake", None)
         #     brake_point = at + 100
-        #     # self.new_msg(brake_point, "now", None)
+        #     # builder.new_msg(brake_point, "now", None)
         #     # this message says "now" and stores the time
-        #     msg = self.new_fn(brake_point, self.brake_debug, None)
+        #     msg = builder.new_fn(brake_point, "brake_debug", None)
         #     # this message calculates the delta
-        #     msg = self.new_fn(brake_point + 100, self.eval_brake_debug, None)
+        #     msg = builder.new_fn(brake_point + 100, "eval_brake_debug", None)
         #     msg["args"] = [brake_point]
         for at in range(0, self.track_length, 100):
             msg = {
@@ -301,7 +257,9 @@ class Coach:
                 "meters": at + 50,
                 "priority": 10,
             }
-            self.new_msg(at, msg, None)
+            builder.new_msg(at, msg, None)
+
+        self.set_plan(builder.build())
 
 
 if __name__ == "__main__":
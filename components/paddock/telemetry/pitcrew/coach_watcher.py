@@ -2,16 +2,16 @@ import threading
 import logging
 import time
 from telemetry.models import Driver, Coach
-
-from .coach import Coach as PitCrewCoach
-from .history import History
-from .mqtt import Mqtt
+from telemetry.notify import COACH_CHANNEL, notifier
 
 
 class CoachWatcher:
-    def __init__(self, firehose):
+    def __init__(self, firehose, dispatcher):
         self.firehose = firehose
-        self.sleep_time = 3
+        self.dispatcher = dispatcher
+        # seconds to wait for coach changes
+        self.sleep_time = 1
+        self.reconcile_time = 60
         self.active_coaches = {}
 
         self._stop_event = threading.Event()
@@ -31,59 +31,74 @@ class CoachWatcher:
         return drivers
 
     def watch_coaches(self):
-        while True and not self.stopped():
-            # sleep longer than save_sessions, to make sure all DB objects are initialized
-            time.sleep(self.sleep_time)
-            drivers = self.drivers()
-            # collect all driver names
-            # driver_names = [driver.name for driver in drivers]
-            # logging.info("checking coaches for drivers: %s", ", ".join(driver_names))
-            coaches = Coach.objects.filter(driver__in=drivers)
-            for coach in coaches:
-                # logging.info(f"{coach.driver} coach enabled: {coach.enabled}")
-                if coach.enabled:
-                    if coach.driver.name not in self.active_coaches.keys():
-                        logging.debug(f"activating coach for {coach.driver}")
-                        self.start_coach(coach.driver.name, coach)
+        """Start and stop coaches when they are changed or their driver shows up.
+
+        Saving a coach sends a notification with the driver id. The coaches of
+        drivers with new sessions are checked once, all coaches are reconciled
+        with the database every reconcile_time seconds in case a notification
+        got lost.
+        """
+        listener = None
+        known_drivers = set()
+        next_reconcile = 0
+        try:
+            while True and not self.stopped():
+                if listener is None:
+                    try:
+                        listener = notifier.listen(COACH_CHANNEL)
+                    except Exception as e:
+                        logging.error(f"Error listening for coach changes: {e}")
+
+                changed = set()
+                if listener:
+                    try:
+                        changed = {int(pk) for pk in listener.get(self.sleep_time)}
+                    except Exception as e:
+                        logging.error(f"Error receiving coach changes: {e}")
+                        listener.close()
+                        listener = None
+                else:
+                    self._stop_event.wait(self.sleep_time)
+
+                drivers = {driver.pk for driver in self.drivers()}
+                if time.monotonic() >= next_reconcile:
+                    check = drivers
+                    next_reconcile = time.monotonic() + self.reconcile_time
                 else:
-                    if coach.driver.name in self.active_coaches.keys():
-                        logging.debug(f"deactivating coach for {coach.driver}")
-                        self.stop_coach(coach.driver.name)
+                    active = {coach.pk for coach in self.active_coaches.values()}
+                    check = (drivers - known_drivers) | (changed & (drivers | active))
+                known_drivers = drivers
+
+                if check:
+                    self.update_coaches(check)
+        finally:
+            if listener:
+                listener.close()
+
+    def update_coaches(self, driver_ids):
+        coaches = Coach.objects.filter(driver__in=driver_ids).select_related("driver")
+        coaches = {coach.pk: coach for coach in coaches}
+        for driver_id in driver_ids:
+            coach = coaches.get(driver_id)
+            if coach and coach.enabled:
+                if coach.driver.name not in self.active_coaches.keys():
+                    logging.debug(f"activating coach for {coach.driver}")
+                    self.start_coach(coach.driver.name, coach)
+            else:
+                for driver_name, active in list(self.active_coaches.items()):
+                    if active.pk == driver_id:
+                        logging.debug(f"deactivating coach for {driver_name}")
+                        self.stop_coach(driver_name)
 
     def stop_coach(self, driver_name):
         if driver_name not in self.active_coaches.keys():
             return
-        self.active_coaches[driver_name][0].disconnect()
-        self.active_coaches[driver_name][1].disconnect()
+        self.dispatcher.remove_coach(driver_name)
         del self.active_coaches[driver_name]
 
-    def start_coach(self, driver_name, coach, debug=False, replay=False):
-        history = History()
-        coach = PitCrewCoach(history, coach, debug=debug)
-        mqtt = Mqtt(coach, driver_name, replay=replay)
-
-        def history_thread():
-            logging.info(f"History thread starting for {driver_name}")
-            history.run()
-            logging.info(f"History thread stopped for {driver_name}")
-
-        h = threading.Thread(target=history_thread)
-        h.name = f"history-{driver_name}"
-
-        def mqtt_thread():
-            logging.info(f"MQTT thread starting for {driver_name}")
-            mqtt.run()
-            logging.info(f"MQTT thread stopped for {driver_name}")
-
-        c = threading.Thread(target=mqtt_thread)
-        c.name = f"mqtt-{driver_name}"
-
-        threads = list()
-        threads.append(h)
-        threads.append(c)
-        c.start()
-        h.start()
-        self.active_coaches[driver_name] = [history, mqtt]
+    def start_coach(self, driver_name, coach, debug=False):
+        self.dispatcher.add_coach(driver_name, coach, debug=debug)
+        self.active_coaches[driver_name] = coach
 
     def run(self):
         try:
@@ -6,10 +6,15 @@ import signal
 
 from .firehose import Firehose
 from .coach_watcher import CoachWatcher
+from .dispatcher import CoachDispatcher
+from .journal import LapJournal
 from .session_saver import SessionSaver
 
 from flask_healthz import HealthError
 
+# directory of the local lap journal, laps are not journaled if unset
+B4MAD_RACING_LAP_JOURNAL = os.environ.get("B4MAD_RACING_LAP_JOURNAL", "")
+
 
 class Crew:
     def __init__(self, debug=False, replay=False):
@@ -18,13 +23,21 @@ class Crew:
         self.debug = debug
         self.replay = replay
 
-        self.firehose = Firehose(debug=debug, replay=replay)
+        self.coach_dispatcher = CoachDispatcher()
+        self.firehose = Firehose(
+            debug=debug, replay=replay, dispatcher=self.coach_dispatcher
+        )
 
-        self.coach_watcher = CoachWatcher(self.firehose)
-        self.coach_watcher.sleep_time = 3
+        self.coach_watcher = CoachWatcher(self.firehose, self.coach_dispatcher)
+        # coaches are started on change notifications, this is the safety net scan
+        self.coach_watcher.reconcile_time = 60
 
-        self.session_saver = SessionSaver(self.firehose, debug=debug)
-        self.session_saver.sleep_time = 5
+        journal = None
+        if B4MAD_RACING_LAP_JOURNAL and not debug:
+            journal = LapJournal(B4MAD_RACING_LAP_JOURNAL)
+        self.session_saver = SessionSaver(self.firehose, debug=debug, journal=journal)
+        # the session saver reacts to session events, this is the safety net scan
+        self.session_saver.sleep_time = 60
 
         self._stop_event = threading.Event()
 
@@ -47,6 +60,9 @@ class Crew:
         if not self._ready:
             raise HealthError("not ready yet")
 
+    def metrics(self):
+        return self.coach_dispatcher.metrics() + self.firehose.metrics()
+
     def run(self):
 
         # log my process id
@@ -55,12 +71,19 @@ class Crew:
         # add signal handling for SIGTERM
         signal.signal(signal.SIGTERM, self._handle_sigterm)
 
+        # coach worker processes are forked before any other thread is started
+        self.coach_dispatcher.start_workers()
+
         threads = []
 
         t = threading.Thread(target=self.firehose.run)
         t.name = "firehose"
         threads.append(t)
 
+        t = threading.Thread(target=self.coach_dispatcher.run)
+        t.name = "coach_dispatcher"
+        threads.append(t)
+
         t = threading.Thread(target=self.coach_watcher.run)
         t.name = "coach_watcher"
         threads.append(t)
@@ -86,6 +109,7 @@ class Crew:
 
         self.firehose.stop()
         self.coach_watcher.stop()
+        self.coach_dispatcher.stop()
         self.session_saver.stop()
 
         for t in threads:
@@ -0,0 +1,121 @@
+import json
+import logging
+import threading
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover - optional fast path
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional fast path
+    orjson = None
+
+
+class TelemetryDecoder:
+    """Decode the telemetry part of a crewchief MQTT payload.
+
+    Consumers declare the telemetry fields they read, only those and the
+    timestamp of the payload are extracted.
+    If msgspec is installed the payload is decoded into a typed struct that
+    skips all undeclared fields while parsing, otherwise orjson or the stdlib
+    json module is used and the declared fields are picked afterwards.
+
+    Args:
+        fields (list): telemetry fields to extract, None extracts everything
+    """
+
+    def __init__(self, fields=None):
+        self.fields = tuple(sorted(set(fields))) if fields is not None else None
+        self.backend = "json"
+        self._loads = json.loads
+        self._decoder = None
+
+        if msgspec and self.fields is not None:
+            telemetry = msgspec.defstruct(
+                "Telemetry", [(field, object, None) for field in self.fields]
+            )
+            payload = msgspec.defstruct(
+                "Payload",
+                [
+                    # coerced by _timestamp, some clients send a string
+                    ("time", object, None),
+                    ("telemetry", telemetry | None, None),
+                ],
+            )
+            self._decoder = msgspec.json.Decoder(payload)
+            self.backend = "msgspec"
+        elif orjson:
+            self._loads = orjson.loads
+            self.backend = "orjson"
+
+        # the decoder is shared by the firehose workers
+        self._stats_lock = threading.Lock()
+        self.decode_count = 0
+        self.decode_errors = 0
+        logging.debug(f"telemetry decoder backend: {self.backend}")
+
+    def decode(self, payload):
+        """Decode a raw MQTT payload.
+
+        Args:
+            payload (bytes): the raw message payload
+
+        Returns:
+            tuple: the timestamp in milliseconds (or None) and a dict of the
+                declared telemetry fields, which is None if the payload is invalid
+        """
+        timestamp = None
+        try:
+            if self._decoder:
+                message = self._decoder.decode(payload)
+                timestamp = self._timestamp(message.time)
+                telemetry = message.telemetry
+                if telemetry is not None:
+                    telemetry = {
+                        field: value
+                        for field in self.fields
+                        if (value := getattr(telemetry, field)) is not None
+                    }
+            else:
+                message = self._loads(payload)
+                timestamp = self._timestamp(message.get("time"))
+                telemetry = message.get("telemetry")
+                if telemetry is not None and self.fields is not None:
+                    telemetry = {
+                        field: telemetry[field]
+                        for field in self.fields
+                        if field in telemetry
+                    }
+        except Exception as e:
+            error = True
+            logging.error("Error decoding payload: %s", e)
+            telemetry = None
+        else:
+            error = False
+        with self._stats_lock:
+            self.decode_count += 1
+            if error:
+                self.decode_errors += 1
+        return timestamp, telemetry
+
+    @staticmethod
+    def _timestamp(value):
+        """Return the timestamp as a number, numeric strings are converted, None if it is invalid."""
+        if value is None or type(value) in (int, float):
+            return value
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            logging.debug("invalid payload timestamp: %r", value)
+            return None
+
+    def stats(self):
+        """Return the decode counters, the decode time is in the DECODE histogram."""
+        with self._stats_lock:
+            return {
+                "backend": self.backend,
+                "count": self.decode_count,
+                "errors": self.decode_errors,
+            }
@@ -0,0 +1,124 @@
+import bisect
+import os
+
+# deltas published per second and driver, 0 disables them
+B4MAD_RACING_DELTA_RATE = float(os.environ.get("B4MAD_RACING_DELTA_RATE", 2))
+
+
+class SegmentDelta:
+    """The time gained or lost in a segment, over the laps driven."""
+
+    __slots__ = ("turn", "last", "best", "sum", "laps")
+
+    def __init__(self, turn):
+        self.turn = turn
+        self.last = 0.0
+        self.best = None
+        self.sum = 0.0
+        self.laps = 0
+
+    def add(self, delta):
+        self.last = delta
+        if self.best is None or delta < self.best:
+            self.best = delta
+        self.sum += delta
+        self.laps += 1
+
+    def to_dict(self):
+        return {
+            "turn": self.turn,
+            "delta": round(self.last, 3),
+            "avg": round(self.sum / self.laps, 3),
+            "best": round(self.best, 3),
+            "laps": self.laps,
+        }
+
+
+class LapDelta:
+    """Running time delta of the current lap to the fast lap.
+
+    The lap time of the fast lap at every full meter is looked up in the
+    time table of its profile, so an update costs the same on every track.
+    A positive delta is time lost. The start and end of the segments are
+    visited in the order of their distance like the messages of a coach,
+    the delta gained or lost between them is added to the SegmentDelta of
+    the turn. A segment is only measured if the lap started before it.
+
+    Args:
+        profile (FastLapProfile): the profile of the fast lap
+        segments (iterable): the FastLapSegment of the fast lap
+        lap_reset (float): distance drop in meters which starts a new lap
+    """
+
+    START = 0
+    END = 1
+
+    def __init__(self, profile, segments=(), lap_reset=100):
+        self.table = profile.time_table()
+        self.lap_reset = lap_reset
+        self.segments = {}
+        # (distance, kind, turn) of the start and end of every segment
+        events = []
+        for segment in segments:
+            if segment.end <= segment.start:
+                continue
+            self.segments[segment.turn] = SegmentDelta(segment.turn)
+            events.append((segment.start, self.START, segment.turn))
+            events.append((segment.end, self.END, segment.turn))
+        events.sort(key=lambda event: (event[0], event[1]))
+        self.events = events
+        self.positions = [event[0] for event in events]
+        self.next = 0
+        # turn -> delta at the start of the segment in this lap
+        self.started = {}
+        # turns of the segments completed since the last call of completed
+        self._completed = []
+        self.distance = None
+        self.lap_time = 0.0
+        self.delta = 0.0
+
+    def reference(self, distance):
+        """Return the lap time of the fast lap at distance."""
+        table = self.table
+        meter = int(distance)
+        if meter < 0:
+            return table[0]
+        if meter >= len(table) - 1:
+            return table[-1]
+        return table[meter] + (table[meter + 1] - table[meter]) * (distance - meter)
+
+    def update(self, distance, lap_time):
+        """Return the delta to the fast lap at distance after lap_time seconds."""
+        if self.distance is None or distance < self.distance - self.lap_reset:
+            # a new lap, or the first tick in the middle of one
+            self.next = bisect.bisect_left(self.positions, distance)
+            self.started = {}
+        self.distance = distance
+        self.lap_time = lap_time
+        self.delta = delta = lap_time - self.reference(distance)
+
+        events = self.events
+        while self.next < len(events) and events[self.next][0] <= distance:
+            at, kind, turn = events[self.next]
+            self.next += 1
+            if kind == self.START:
+                self.started[turn] = delta
+            elif turn in self.started:
+                self.segments[turn].add(delta - self.started.pop(turn))
+                self._completed.append(turn)
+        return delta
+
+    def completed(self):
+        """Return the SegmentDelta of the segments completed since the last call."""
+        completed = [self.segments[turn] for turn in self._completed]
+        self._completed = []
+        return completed
+
+    def to_dict(self):
+        """Return the current delta and the segments completed since the last call."""
+        return {
+            "distance": round(self.distance or 0, 1),
+            "lap_time": round(self.lap_time, 3),
+            "delta": round(self.delta, 3),
+            "segments": [segment.to_dict() for segment in self.completed()],
+        }
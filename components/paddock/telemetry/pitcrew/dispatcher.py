@@ -0,0 +1,566 @@
+import multiprocessing
+import os
+import threading
+import logging
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, SimpleQueue
+
+from django.db import connections, transaction
+from django.db.models import F
+from telemetry.cache import fast_lap_cache
+from telemetry.models import Coach as DbCoach, FastLap, FastLapSegment
+
+from .batch_queue import BatchQueue
+from .coach import Coach as PitCrewCoach
+from .history import History
+from .metrics import PUBLISH, QUEUE, READY, TOTAL, metrics, render, render_workers
+from .mqtt import Mqtt
+from .segment_stats import SegmentStats
+
+B4MAD_RACING_COACH_WORKERS = int(os.environ.get("B4MAD_RACING_COACH_WORKERS", 4))
+B4MAD_RACING_COACH_QUEUE_SIZE = int(
+    os.environ.get("B4MAD_RACING_COACH_QUEUE_SIZE", 1000)
+)
+# "thread" or "process"
+B4MAD_RACING_COACH_WORKER_MODE = os.environ.get(
+    "B4MAD_RACING_COACH_WORKER_MODE", "thread"
+)
+# seconds between two saves of the segment statistics of the drivers
+B4MAD_RACING_SEGMENT_STATS_INTERVAL = int(
+    os.environ.get("B4MAD_RACING_SEGMENT_STATS_INTERVAL", 60)
+)
+
+
+def filter_from_topic(topic):
+    frags = topic.split("/")
+    driver = frags[1]
+    # session = frags[2]
+    game = frags[3]
+    track = frags[4]
+    car = frags[5]
+    filter = {
+        "Driver": driver,
+        "GameName": game,
+        "TrackCode": track,
+        "CarModel": car,
+    }
+    return filter
+
+
+class ActiveCoach:
+    __slots__ = ("coach", "topic", "filter", "discovered", "init", "lock")
+
+    def __init__(self, coach):
+        self.coach = coach
+        # the session topic the coach is filtered for and its filter
+        self.topic = ""
+        self.filter = None
+        # receive time of the first message of the topic
+        self.discovered = 0.0
+        # the pending history initialization
+        self.init = None
+        # guards topic, filter and discovered, which the initialization reads,
+        # and the filter and readiness of the history
+        self.lock = threading.Lock()
+
+    def session(self):
+        """Return the topic, filter and discovered time of the current session."""
+        with self.lock:
+            return self.topic, self.filter, self.discovered
+
+
+class CoachWorker:
+    """Run the coaches of the drivers pinned to this worker in a thread.
+
+    Ticks are queued as (topic, telemetry, receive_ts, timestamp) and
+    processed in the order they were queued, commands to add and remove coaches are queued
+    separately so they are never dropped. The history of a coach is
+    initialized in the background as soon as the first message of a session
+    arrives, failed initializations are retried every init_interval seconds.
+    The segment statistics of the drivers are saved in one batch every
+    save_interval seconds.
+
+    Args:
+        index (int): the number of the worker
+        publisher (Mqtt): the connection to publish the responses on
+        queue_size (int): maximum number of queued ticks
+    """
+
+    ADD = "add"
+    REMOVE = "remove"
+
+    def __init__(self, index, publisher, queue_size=B4MAD_RACING_COACH_QUEUE_SIZE):
+        self.index = index
+        self.publisher = publisher
+        self.batch_size = 100
+        # seconds between two attempts to initialize a history
+        self.init_interval = 5
+        self._next_init = 0
+        self.save_interval = B4MAD_RACING_SEGMENT_STATS_INTERVAL
+        self._next_save = 0
+        # driver segments of finished sessions which are not saved yet
+        self._unsaved = []
+        # driver name -> ActiveCoach
+        self.coaches = {}
+        self.ticks = 0
+        self.latency_sum = 0.0
+        self.max_latency = 0.0
+        # seconds from the first message of a session until its coach is ready
+        self.ready_count = 0
+        self.ready_sum = 0.0
+        self.max_ready = 0.0
+        self._ready_lock = threading.Lock()
+        # created in the thread or process of the worker
+        self.executor = None
+
+        self.queue = BatchQueue(maxsize=queue_size)
+        self.commands = SimpleQueue()
+        self.thread = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def submit(self, tick):
+        self.queue.put(tick)
+
+    def command(self, *command):
+        self.commands.put(command)
+
+    def next_commands(self):
+        commands = []
+        while True:
+            try:
+                commands.append(self.commands.get_nowait())
+            except Empty:
+                return commands
+
+    def next_batch(self):
+        return self.queue.get_batch(self.batch_size)
+
+    def handle(self, command):
+        if command[0] == self.ADD:
+            kind, driver_name, coach_id, debug = command
+            db_coach = DbCoach.objects.get(pk=coach_id)
+            coach = PitCrewCoach(History(), db_coach, debug=debug)
+            self.coaches[driver_name] = ActiveCoach(coach)
+        elif command[0] == self.REMOVE:
+            active = self.coaches.pop(command[1], None)
+            if active:
+                self.collect_segments(active)
+            metrics.remove_driver(command[1])
+
+    def tick(self, topic, telemetry, receive_ts, timestamp=None):
+        driver = topic.split("/", 2)[1]
+        active = self.coaches.get(driver)
+        if active is None:
+            return
+        metrics.observe(QUEUE, time.time() - receive_ts, driver)
+
+        if active.topic != topic:
+            logging.debug(f"new coaching session {topic}")
+            self.collect_segments(active)
+            filter = filter_from_topic(topic)
+            with active.lock:
+                active.topic = topic
+                active.filter = filter
+                active.discovered = receive_ts
+                active.coach.set_filter(filter)
+            self.init_history(active)
+
+        response = active.coach.get_response(telemetry)
+        if response:
+            logging.debug(f"r-->: {telemetry['DistanceRoundTrack']}: {response}")
+            start = time.perf_counter()
+            self.publisher.publish(f"/coach/{driver}", response)
+            metrics.observe(PUBLISH, time.perf_counter() - start, driver)
+            if timestamp:
+                metrics.observe(TOTAL, time.time() - timestamp / 1000, driver)
+
+        delta = active.coach.delta_response(time.time())
+        if delta:
+            self.publisher.publish(f"/delta/{driver}", delta)
+
+        latency = time.time() - receive_ts
+        self.ticks += 1
+        self.latency_sum += latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+
+    def background(self, fn, *args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=2, thread_name_prefix=f"coach-init-{self.index}"
+            )
+        return self.executor.submit(fn, *args)
+
+    def init_history(self, active):
+        """Initialize the history of the coach in the background."""
+        if active.init and not active.init.done():
+            # the running initialization notices the new topic and starts over
+            return
+        active.init = self.background(self._init_history, active)
+
+    def _init_history(self, active):
+        history = active.coach.history
+        while history.do_init:
+            topic, filter, discovered = active.session()
+            try:
+                ready = history.init(filter)
+            except Exception as e:
+                logging.exception(f"Error initializing history: {e}")
+                return
+            with active.lock:
+                if topic != active.topic:
+                    # the driver started a new session meanwhile
+                    continue
+                history.ready = ready
+                if not ready:
+                    return
+                history.do_init = False
+            latency = time.time() - discovered
+            metrics.observe(READY, latency, active.coach.driver_name)
+            logging.debug(f"coach ready for {topic} after {latency:.2f}s")
+            with self._ready_lock:
+                self.ready_count += 1
+                self.ready_sum += latency
+                self.max_ready = max(self.max_ready, latency)
+
+    def init_histories(self):
+        """Retry the initializations which failed, e.g. for lack of data."""
+        if time.monotonic() < self._next_init:
+            return
+        self._next_init = time.monotonic() + self.init_interval
+        for active in self.coaches.values():
+            if active.topic and active.coach.history.do_init:
+                self.init_history(active)
+
+    def collect_segments(self, active):
+        """Keep the changed driver segments of the coach for the next save."""
+        history = active.coach.history
+        if history.ready:
+            self._unsaved.extend(history.dirty_driver_segments())
+
+    def save_segments(self, force=False):
+        """Save the changed driver segments of all coaches in one batch."""
+        if not force and time.monotonic() < self._next_save:
+            return None
+        self._next_save = time.monotonic() + self.save_interval
+        for active in self.coaches.values():
+            self.collect_segments(active)
+        segments, self._unsaved = self._unsaved, []
+        if not segments:
+            return None
+        if force:
+            return self._save_segments(segments)
+        return self.background(self._save_segments, segments)
+
+    def _save_segments(self, segments):
+        fast_lap_ids = {segment.fast_lap_id for segment in segments}
+        try:
+            # bulk_update sends no post_save, bump the version for the fast lap cache
+            with transaction.atomic():
+                FastLapSegment.objects.bulk_update(
+                    segments, SegmentStats.fields, batch_size=500
+                )
+                FastLap.objects.filter(pk__in=fast_lap_ids).update(
+                    version=F("version") + 1
+                )
+            for fast_lap_id in fast_lap_ids:
+                fast_lap_cache.invalidate(fast_lap_id)
+            logging.debug(f"saved {len(segments)} driver segments")
+        except Exception as e:
+            logging.exception(f"Error saving driver segments: {e}")
+
+    def work(self):
+        while not self.stopped():
+            for command in self.next_commands():
+                try:
+                    self.handle(command)
+                except Exception as e:
+                    logging.exception(f"Error handling coach command {command}: {e}")
+
+            for topic, telemetry, receive_ts, timestamp in self.next_batch():
+                try:
+                    self.tick(topic, telemetry, receive_ts, timestamp)
+                except Exception as e:
+                    logging.exception(f"Error coaching {topic}: {e}")
+
+            self.init_histories()
+            self.save_segments()
+            self.publish_stats()
+
+        self.save_segments(force=True)
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+    def publish_stats(self):
+        pass
+
+    def start(self):
+        self.thread = threading.Thread(target=self.work)
+        self.thread.name = f"coach-worker-{self.index}"
+        self.thread.start()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    def metrics(self):
+        """Return the metrics snapshot of a worker process, thread workers record in metrics."""
+        return None
+
+    def depth(self):
+        return len(self.queue)
+
+    def dropped(self):
+        return self.queue.dropped
+
+    def counters(self):
+        return (
+            len(self.coaches),
+            self.ticks,
+            self.latency_sum,
+            self.max_latency,
+            self.ready_count,
+            self.ready_sum,
+            self.max_ready,
+        )
+
+    def stats(self):
+        (
+            coaches,
+            ticks,
+            latency_sum,
+            max_latency,
+            ready_count,
+            ready_sum,
+            max_ready,
+        ) = self.counters()
+        avg_latency = latency_sum / ticks if ticks else 0
+        avg_ready = ready_sum / ready_count if ready_count else 0
+        return {
+            "worker": self.index,
+            "coaches": int(coaches),
+            "depth": self.depth(),
+            "dropped": self.dropped(),
+            "ticks": int(ticks),
+            "avg_latency_ms": avg_latency * 1000,
+            "max_latency_ms": max_latency * 1000,
+            "ready": int(ready_count),
+            "avg_ready_s": avg_ready,
+            "max_ready_s": max_ready,
+        }
+
+
+class CoachWorkerProcess(CoachWorker):
+    """A coach worker running in a forked process, to escape the GIL.
+
+    The process publishes over its own MQTT connection and shares its
+    counters with the parent process. Its latency metrics are sent to the
+    parent process every metrics_interval seconds.
+    """
+
+    def __init__(self, index, queue_size=B4MAD_RACING_COACH_QUEUE_SIZE):
+        super().__init__(index, None, queue_size)
+        context = multiprocessing.get_context("fork")
+        self.queue = context.Queue(maxsize=queue_size)
+        self.commands = context.Queue()
+        self._dropped = 0
+        # the values of CoachWorker.counters
+        self._counters = context.Array("d", 7)
+        self._metrics = context.Queue()
+        self._last_metrics = None
+        self.metrics_interval = 1
+        self._next_metrics = 0
+        self._stop_event = context.Event()
+        self.process = context.Process(target=self.work_process)
+        self.process.name = f"coach-worker-{self.index}"
+
+    def submit(self, tick):
+        try:
+            self.queue.put_nowait(tick)
+        except Full:
+            self._dropped += 1
+
+    def next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=1)]
+        except Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def publish_stats(self):
+        self._counters[:] = super().counters()
+        if time.monotonic() > self._next_metrics:
+            self._next_metrics = time.monotonic() + self.metrics_interval
+            self._metrics.put(metrics.snapshot())
+
+    def metrics(self):
+        while True:
+            try:
+                self._last_metrics = self._metrics.get_nowait()
+            except Empty:
+                return self._last_metrics
+
+    def work_process(self):
+        # only the ticks of this process
+        metrics.clear()
+        self.publisher = Mqtt()
+        self.publisher.connect()
+        try:
+            self.work()
+        finally:
+            self.publisher.disconnect()
+
+    def start(self):
+        # the forked process must not share the database connection of the parent
+        connections.close_all()
+        self.process.start()
+
+    def join(self, timeout=None):
+        self.process.join(timeout)
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def dropped(self):
+        return self._dropped
+
+    def counters(self):
+        return self._counters[:]
+
+
+class CoachDispatcher:
+    """Route the telemetry of the firehose to the active coaches.
+
+    The firehose already receives and decodes the messages of all drivers, it
+    hands every message to dispatch. The coaches run on a bounded pool of
+    workers, threads or processes. Drivers are pinned to a worker by the hash
+    of their name, so the ticks of a driver are processed in order. The
+    thread workers publish the responses over one shared MQTT connection.
+
+    Args:
+        publisher (Mqtt): the connection to publish the responses on
+        workers (int): number of coach workers
+        mode (str): run the workers as "thread" or "process"
+        queue_size (int): maximum number of queued ticks per worker
+    """
+
+    THREAD = "thread"
+    PROCESS = "process"
+
+    # telemetry fields read by the coaches
+    fields = History.fields
+
+    def __init__(
+        self,
+        publisher=None,
+        workers=B4MAD_RACING_COACH_WORKERS,
+        mode=B4MAD_RACING_COACH_WORKER_MODE,
+        queue_size=B4MAD_RACING_COACH_QUEUE_SIZE,
+    ):
+        if mode not in [self.THREAD, self.PROCESS]:
+            raise ValueError(f"unknown coach worker mode {mode}")
+        self.publisher = publisher or Mqtt()
+        self.mode = mode
+        self.stats_interval = 60
+        if mode == self.PROCESS:
+            self.workers = [CoachWorkerProcess(i, queue_size) for i in range(workers)]
+        else:
+            self.workers = [
+                CoachWorker(i, self.publisher, queue_size) for i in range(workers)
+            ]
+        # driver name -> worker of the active coaches
+        self.drivers = {}
+        self._started = False
+
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def worker_for(self, driver_name):
+        return self.workers[zlib.crc32(driver_name.encode()) % len(self.workers)]
+
+    def add_coach(self, driver_name, db_coach, debug=False):
+        worker = self.worker_for(driver_name)
+        worker.command(CoachWorker.ADD, driver_name, db_coach.pk, debug)
+        self.drivers[driver_name] = worker
+
+    def remove_coach(self, driver_name):
+        worker = self.drivers.pop(driver_name, None)
+        if worker:
+            worker.command(CoachWorker.REMOVE, driver_name)
+
+    def dispatch(self, topic, telemetry, receive_ts, timestamp=None):
+        """Queue the message for the coach of the driver of topic, if there is one.
+
+        Args:
+            topic (str): the session topic without replay prefix
+            telemetry (dict): the decoded telemetry
+            receive_ts (float): the time the message was received
+            timestamp (float): the client time of the telemetry in milliseconds
+        """
+        if not self.drivers:
+            return
+        worker = self.drivers.get(topic.split("/", 2)[1])
+        if worker:
+            worker.submit((topic, telemetry, receive_ts, timestamp))
+
+    def start_workers(self):
+        """Start the workers, process workers are forked before other threads start."""
+        if self._started:
+            return
+        self._started = True
+        for worker in self.workers:
+            worker.start()
+
+    def stats(self):
+        """Return the queue depth and tick latency of every worker."""
+        return [worker.stats() for worker in self.workers]
+
+    def metrics(self):
+        """Return the latency histograms and the queue stats of all workers in the Prometheus text format."""
+        snapshots = [metrics.snapshot()]
+        for worker in self.workers:
+            snapshot = worker.metrics()
+            if snapshot:
+                snapshots.append(snapshot)
+        return render(snapshots) + render_workers(self.stats())
+
+    def run(self):
+        if self.mode == self.THREAD:
+            self.publisher.connect()
+        self.start_workers()
+        next_stats = time.monotonic() + self.stats_interval
+        try:
+            while not self._stop_event.wait(1):
+                # keep the metrics of the worker processes from queueing up
+                for worker in self.workers:
+                    worker.metrics()
+                if time.monotonic() < next_stats:
+                    continue
+                next_stats = time.monotonic() + self.stats_interval
+                for stats in self.stats():
+                    logging.debug(f"coach worker stats: {stats}")
+        finally:
+            for worker in self.workers:
+                worker.stop()
+            for worker in self.workers:
+                worker.join(timeout=10)
+            if self.mode == self.THREAD:
+                self.publisher.disconnect()
+            logging.info("CoachDispatcher stopped")
@@ -0,0 +1,61 @@
+import math
+
+
+class TimerWheel:
+    """Hashed timer wheel for expiring keys.
+
+    Keys are put into the slot of their deadline, scheduling and expiring a key
+    is O(1). Deadlines further away than one revolution are kept in their slot
+    until the wheel comes around again.
+
+    Args:
+        resolution (float): seconds per slot
+        slots (int): number of slots of the wheel
+    """
+
+    def __init__(self, resolution=1.0, slots=1024):
+        self.resolution = resolution
+        self.slots = [dict() for _ in range(slots)]
+        self.deadlines = {}
+        self.tick = None
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def _slot(self, tick):
+        return self.slots[tick % len(self.slots)]
+
+    def schedule(self, key, deadline):
+        """(Re)schedule key to expire at deadline (seconds)."""
+        self.cancel(key)
+        tick = math.ceil(deadline / self.resolution)
+        if self.tick is not None and tick <= self.tick:
+            tick = self.tick + 1
+        self.deadlines[key] = tick
+        self._slot(tick)[key] = tick
+
+    def cancel(self, key):
+        tick = self.deadlines.pop(key, None)
+        if tick is not None:
+            self._slot(tick).pop(key, None)
+
+    def advance(self, now):
+        """Advance the wheel to now and return the keys which are due."""
+        target = math.floor(now / self.resolution)
+        if self.tick is None:
+            self.tick = target - 1
+        expired = []
+        # never walk more than one revolution, every slot is visited then
+        start = max(self.tick + 1, target - len(self.slots) + 1)
+        for tick in range(start, target + 1):
+            slot = self._slot(tick)
+            for key, key_tick in list(slot.items()):
+                if key_tick <= target:
+                    del slot[key]
+                    del self.deadlines[key]
+                    expired.append(key)
+        self.tick = target
+        return expired
@@ -1,14 +1,56 @@
+import functools
 import os
 import threading
 import logging
+import time
+import zlib
+from queue import SimpleQueue
 import paho.mqtt.client as mqtt
-import json
 
-from .session import Session
+from .batch_queue import BatchQueue
+from .clock import TelemetryClock
+from .decoder import TelemetryDecoder
+from .eviction import TimerWheel
+from .metrics import BROKER, DECODE, metrics, render_decoder, render_queues
+from .session import Session, LAP_FINISHED, SESSION_CREATED
+from .sharding import ShardCoordinator
+
+B4MAD_RACING_MQTT_HOST = os.environ.get(
+    "B4MAD_RACING_MQTT_HOST", "telemetry.b4mad.racing"
+)
+B4MAD_RACING_MQTT_PORT = int(os.environ.get("B4MAD_RACING_MQTT_PORT", 31883))
+
+B4MAD_RACING_FIREHOSE_WORKERS = int(os.environ.get("B4MAD_RACING_FIREHOSE_WORKERS", 1))
+B4MAD_RACING_FIREHOSE_QUEUE_SIZE = int(
+    os.environ.get("B4MAD_RACING_FIREHOSE_QUEUE_SIZE", 10000)
+)
+B4MAD_RACING_FIREHOSE_BATCH_SIZE = int(
+    os.environ.get("B4MAD_RACING_FIREHOSE_BATCH_SIZE", 100)
+)
+B4MAD_RACING_FIREHOSE_OVERFLOW = os.environ.get(
+    "B4MAD_RACING_FIREHOSE_OVERFLOW", BatchQueue.DROP_OLDEST
+)
+B4MAD_RACING_FIREHOSE_SHARD_ID = os.environ.get("B4MAD_RACING_FIREHOSE_SHARD_ID", "")
+B4MAD_RACING_SESSION_TTL = int(os.environ.get("B4MAD_RACING_SESSION_TTL", 600))
+B4MAD_RACING_MAX_SESSIONS = int(os.environ.get("B4MAD_RACING_MAX_SESSIONS", 1000))
+B4MAD_RACING_MAX_LAPS = int(os.environ.get("B4MAD_RACING_MAX_LAPS", 20))
 
 
 class Firehose:
-    def __init__(self, debug=False, replay=False):
+    def __init__(
+        self,
+        debug=False,
+        replay=False,
+        workers=B4MAD_RACING_FIREHOSE_WORKERS,
+        queue_size=B4MAD_RACING_FIREHOSE_QUEUE_SIZE,
+        batch_size=B4MAD_RACING_FIREHOSE_BATCH_SIZE,
+        overflow=B4MAD_RACING_FIREHOSE_OVERFLOW,
+        shard_id=B4MAD_RACING_FIREHOSE_SHARD_ID,
+        session_ttl=B4MAD_RACING_SESSION_TTL,
+        max_sessions=B4MAD_RACING_MAX_SESSIONS,
+        max_laps=B4MAD_RACING_MAX_LAPS,
+        dispatcher=None,
+    ):
         mqttc = mqtt.Client()
         mqttc.on_message = self.on_message
         mqttc.on_connect = self.on_connect
@@ -22,18 +64,55 @@ class Firehose:
 
         self.replay = replay
         self.debug = debug
+        # only subscribe to the sessions of this driver, e.g. to coach a single driver
+        self.driver = None
 
         self.sessions = {}
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
+        self.max_laps = max_laps
+        self.evict_interval = 10
+        self._next_eviction = 0
+        self._evict_lock = threading.Lock()
+        self._expiry = TimerWheel()
+        # the coach dispatcher receives every decoded message
+        self.dispatcher = dispatcher
+        fields = Session.fields
+        if dispatcher:
+            fields = fields + dispatcher.fields
+        self.decoder = TelemetryDecoder(fields)
+        self.clock = TelemetryClock()
+        # session and lap events, only emitted once the session saver consumes them
+        self.events = None
+
+        # the network thread only queues raw messages, the workers process them.
+        # messages of one topic always go to the same worker to keep their order.
+        self.batch_size = batch_size
+        self.queues = [
+            BatchQueue(maxsize=queue_size, policy=overflow) for _ in range(workers)
+        ]
+        self.workers = []
         self._stop_event = threading.Event()
 
+        # in sharded mode this firehose only handles the drivers it owns
+        self.shard = None
+        if shard_id:
+            self.shard = ShardCoordinator(self, shard_id)
+            self.shard.setup(mqttc)
+
     def stop(self):
         self._stop_event.set()
 
     def stopped(self):
         return self._stop_event.is_set()
 
+    def disconnect(self):
+        if self.shard:
+            self.shard.leave(self.mqttc)
+        self.mqttc.disconnect()
+
     def on_message(self, mqttc, obj, msg):
-        """Handle incoming messages, we are only interested in the telemetry.
+        """Queue incoming messages, they are processed by the worker threads.
 
         Args:
             mqttc (_type_): the mqtt client
@@ -46,18 +125,102 @@ class Firehose:
         # )
 
         if self.stopped():
-            self.mqttc.disconnect()
+            self.disconnect()
+            return
+
+        if self.shard and not self.shard.owns(msg.topic):
+            return
+
+        self.queue_for(msg.topic).put((msg.topic, msg.payload, time.time()))
+
+    def queue_for(self, topic):
+        """Return the worker queue of the messages of topic."""
+        if len(self.queues) > 1:
+            return self.queues[zlib.crc32(topic.encode()) % len(self.queues)]
+        return self.queues[0]
+
+    def run_in_order(self, session_id, fn, *args):
+        """Run fn on the worker of a session after the messages queued for it.
+
+        The session is only changed by its worker, so e.g. handing it over
+        does not race with a tick. Once the workers stopped fn runs right
+        away, after they are joined.
+
+        Args:
+            session_id (str): the id of the session, its topic
+            fn (callable): called with args
+        """
+        if self.stopped() or not self.workers:
+            self.join_workers()
+            fn(*args)
+            return
+        topic = session_id
+        if self.replay:
+            topic = f"replay/{session_id}"
+        self.queue_for(topic).put(functools.partial(fn, *args), force=True)
+
+    def stats(self):
+        """Return the depth and drop counters of the worker queues."""
+        return [dict(queue.stats(), worker=i) for i, queue in enumerate(self.queues)]
+
+    def metrics(self):
+        """Return the stats of the worker queues and the decoder in the Prometheus text format."""
+        return render_queues(self.stats()) + render_decoder(self.decoder.stats())
+
+    def consume(self, queue):
+        dropped = 0
+        while not self.stopped():
+            for item in queue.get_batch(self.batch_size):
+                if callable(item):
+                    # a command queued by run_in_order
+                    try:
+                        item()
+                    except Exception as e:
+                        logging.exception(f"Error running {item.func.__name__}: {e}")
+                    continue
+                topic, payload, receive_ts = item
+                try:
+                    self.process(topic, payload, receive_ts)
+                except Exception as e:
+                    logging.exception(f"Error processing {topic}: {e}")
+
+            if queue.dropped != dropped:
+                logging.warning(
+                    f"firehose queue dropped {queue.dropped - dropped} messages"
+                    + f", depth {len(queue)}"
+                )
+                dropped = queue.dropped
+
+            if time.monotonic() > self._next_eviction:
+                if self._evict_lock.acquire(blocking=False):
+                    try:
+                        self.clear_sessions(time.time())
+                    except Exception as e:
+                        logging.exception(f"Error clearing sessions: {e}")
+                    finally:
+                        self._next_eviction = time.monotonic() + self.evict_interval
+                        self._evict_lock.release()
+
+    def process(self, topic, payload, receive_ts):
+        """Handle a queued message, we are only interested in the telemetry.
 
-        topic = msg.topic
+        Args:
+            topic (str): the topic of the message
+            payload (bytes): the raw payload
+            receive_ts (float): the time the message was received
+        """
         if self.replay and topic.startswith("replay/"):
             # remove replay/ prefix from session
             topic = topic[7:]
 
-        try:
-            payload = json.loads(msg.payload.decode("utf-8")).get("telemetry")
-        except Exception as e:
-            logging.error("Error decoding payload: %s", e)
+        start = time.perf_counter()
+        timestamp, payload = self.decoder.decode(payload)
+        metrics.observe(DECODE, time.perf_counter() - start)
+        if payload is None:
             return
+        # the timestamps of replayed sessions are those of the recording
+        if timestamp and not self.replay:
+            metrics.observe(BROKER, max(receive_ts - timestamp / 1000, 0.0))
 
         if topic not in self.sessions:
             try:
@@ -74,8 +237,12 @@ class Firehose:
                 # ignore invalid session
                 return
 
+            if self.shard and not self.shard.owns(topic):
+                # queued before the session was handed over to another member
+                return
+
             logging.debug(f"New session: {topic}")
-            session = Session(topic)
+            session = Session(topic, clock=self.clock, timestamp=timestamp)
             session.driver = driver
             session.session_id = session_id
             session.game_name = game
@@ -84,34 +251,110 @@ class Firehose:
             session.session_type = session_type
             if self.replay:
                 session.session_type = "replay"
-            self.sessions[topic] = session
+            session.touched = receive_ts
+            self.add_session(session)
 
         session = self.sessions[topic]
-        session.signal(payload)
+        session.touched = receive_ts
+        session.signal(payload, timestamp)
+
+        if self.dispatcher:
+            if self.replay:
+                timestamp = None
+            self.dispatcher.dispatch(topic, payload, receive_ts, timestamp)
+
+    def enable_events(self):
+        """Emit the session and lap events of all sessions, return the event queue."""
+        if self.events is None:
+            self.events = SimpleQueue()
+            for session in list(self.sessions.values()):
+                session.events = self.events
+        return self.events
+
+    def add_session(self, session):
+        session.events = self.events
+        self.sessions[session.id] = session
+        self._expiry.schedule(session.id, session.touched + self.session_ttl)
+        session.emit(SESSION_CREATED)
+
+    def adopt_session(self, state):
+        """Take over a session handed over by another firehose member.
+
+        The handed over laps were not saved by the previous owner, the
+        finished ones are emitted to the session saver. If we already started
+        a session for the topic, the lap the previous owner was measuring is
+        merged with the same lap of our session or continued if we did not
+        start a lap yet.
+        """
+        session = Session.from_dict(state, clock=self.clock)
+        session.touched = time.time()
+        current = self.sessions.get(session.id)
+        if current is None:
+            self.add_session(session)
+            current = session
+        else:
+            laps = [lap for lap in session.laps if lap.finished]
+            # the lap the previous owner was measuring
+            lap = session.laps[-1] if session.laps else None
+            if lap is not None and not lap.finished:
+                first = current.laps[0] if current.laps else None
+                if first is None:
+                    laps.append(lap)
+                    current.current_lap = max(current.current_lap, session.current_lap)
+                elif first.number == lap.number and lap.number >= 0:
+                    first.start = min(first.start, lap.start)
+                else:
+                    logging.warning(
+                        f"{session.id}\n\t dropping unfinished lap {lap.number} of the handover"
+                        + f", we are measuring lap {first.number}"
+                    )
+            current.laps[0:0] = laps
+            current.start = min(current.start, session.start)
+        for lap in session.laps:
+            if lap.finished:
+                current.emit(LAP_FINISHED, lap)
 
-    # TODO: clear sessions every now and then
     def clear_sessions(self, now):
-        delete_sessions = []
-        for topic, session in self.sessions.items():
-            # delete session without updates for 10 minutes
-            if (now - session["end"]).seconds > 600:
-                delete_sessions.append(topic)
-
-            # get the length of the session['laps'] list and count down the index
-            # and delete the lap if it has the delete flag set
-            for i in range(len(session["laps"]) - 1, -1, -1):
-                lap = session["laps"][i]
-                if lap.get("delete", False):
-                    logging.debug(f"{topic}\n\t deleting lap {lap['number']}")
-                    del session["laps"][i]
-
-        # delete all sessions by iterating over delete_sessions
-        for topic in delete_sessions:
-            del self.sessions[topic]
+        """Evict idle sessions and laps which are saved already.
+
+        Sessions are expired via a timer wheel, a session which received
+        updates since it was scheduled is rescheduled at its new idle deadline.
+
+        Args:
+            now (float): the server time in seconds since the epoch
+        """
+        for topic in self._expiry.advance(now):
+            session = self.sessions.get(topic)
+            if session is None:
+                continue
+            deadline = session.touched + self.session_ttl
+            if deadline > now:
+                self._expiry.schedule(topic, deadline)
+                continue
+            # delete session without updates for session_ttl seconds
+            self.delete_session(topic)
             logging.debug(f"{topic}\n\t deleting inactive session")
 
+        if len(self.sessions) > self.max_sessions:
+            sessions = sorted(
+                self.sessions.values(), key=lambda session: session.touched
+            )
+            for session in sessions[: len(sessions) - self.max_sessions]:
+                self.delete_session(session.id)
+                logging.info(f"{session.id}\n\t deleting session, too many sessions")
+
+        # the laps are only changed by the worker of the session
+        for session in list(self.sessions.values()):
+            self.run_in_order(session.id, session.prune_laps, self.max_laps)
+
+    def delete_session(self, topic):
+        self.sessions.pop(topic, None)
+        self._expiry.cancel(topic)
+
     def on_connect(self, mqttc, obj, flags, rc):
         logging.debug("on_connect rc: %s", str(rc))
+        if self.shard:
+            self.shard.on_connect(mqttc)
 
     def on_publish(self, mqttc, obj, mid):
         # logging.debug("mid: %s", str(mid))
@@ -125,12 +368,24 @@ class Firehose:
     def on_log(self, mqttc, obj, level, string):
         pass
 
+    def start_workers(self):
+        for i, queue in enumerate(self.queues):
+            t = threading.Thread(target=self.consume, args=(queue,))
+            t.name = f"firehose-worker-{i}"
+            t.start()
+            self.workers.append(t)
+
     def run(self):
-        self.mqttc.connect("telemetry.b4mad.racing", 31883, 60)
+        self.start_workers()
+        self.mqttc.connect(B4MAD_RACING_MQTT_HOST, B4MAD_RACING_MQTT_PORT, 60)
         if self.replay:
-            topic = "replay/#"
+            topic = "replay"
+        else:
+            topic = "crewchief"
+        if self.driver:
+            topic = f"{topic}/{self.driver}/#"
         else:
-            topic = "crewchief/#"
+            topic = f"{topic}/#"
 
         s = self.mqttc.subscribe(topic, 0)
         if s[0] == mqtt.MQTT_ERR_SUCCESS:
@@ -138,3 +393,12 @@ class Firehose:
             self.mqttc.loop_forever()
         else:
             logging.error(f"Failed to subscribe to {topic}")
+
+        self.stop()
+        self.join_workers()
+
+    def join_workers(self):
+        current = threading.current_thread()
+        for t in self.workers:
+            if t is not current:
+                t.join()
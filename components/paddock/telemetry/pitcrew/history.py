@@ -1,26 +1,46 @@
 #!/usr/bin/env python3
 
+import copy
 import threading
 import os
 
 # import pickle
-import pandas as pd
+import numpy as np
 import time
 import logging
-from telemetry.models import Game, FastLap, FastLapSegment, Driver
+from telemetry.cache import fast_lap_cache, identity_cache
+from telemetry.models import Game, Car, Track, FastLapSegment, Driver
 from telemetry.analyzer import Analyzer
 
 from influxdb_client import InfluxDBClient
 
+from .message_cursor import MessageCursor
+from .ring_buffer import TelemetryRingBuffer
+from .segment_stats import SegmentStats
+
 B4MAD_RACING_INFLUX_ORG = os.environ.get("B4MAD_RACING_INFLUX_ORG", "b4mad")
 B4MAD_RACING_INFLUX_TOKEN = os.environ.get("B4MAD_RACING_INFLUX_TOKEN", "")
 B4MAD_RACING_INFLUX_URL = os.environ.get(
     "B4MAD_RACING_INFLUX_URL", "https://telemetry.b4mad.racing/"
 )
+# number of ticks of live telemetry kept per driver
+B4MAD_RACING_HISTORY_CAPACITY = int(
+    os.environ.get("B4MAD_RACING_HISTORY_CAPACITY", 12000)
+)
 
 
 class History:
-    def __init__(self):
+    # telemetry fields recorded by update
+    fields = [
+        "DistanceRoundTrack",
+        "Gear",
+        "SpeedMs",
+        "Throttle",
+        "Brake",
+        "CurrentLapTime",
+    ]
+
+    def __init__(self, capacity=B4MAD_RACING_HISTORY_CAPACITY):
         self.client = InfluxDBClient(
             url=B4MAD_RACING_INFLUX_URL,
             token=B4MAD_RACING_INFLUX_TOKEN,
@@ -36,7 +56,17 @@ class History:
         self.do_run = True
         self.driver = None
         self.track_length = 0
-        self.telemetry = pd.DataFrame()
+        self.snapshot = None
+        self.driver_segments = {}
+        # turn -> SegmentStats of the driver
+        self.driver_stats = {}
+        # the segments are measured after their end, see init_driver
+        self.stats_cursor = None
+        self.stats_at = {}
+        # the latest telemetry of the driver
+        self.telemetry = TelemetryRingBuffer(
+            self.fields, capacity, distance="DistanceRoundTrack"
+        )
         self.analyzer = Analyzer()
 
     def disconnect(self):
@@ -52,62 +82,71 @@ class History:
 
     def set_filter(self, filter):
         self.filter = filter
+        # the segments of the previous filter are no longer valid
+        self.ready = False
         self.do_init = True
 
-    def init(self):
+    def init(self, filter=None):
+        """Load the fast lap data of filter, by default of the filter set last."""
+        if filter is None:
+            filter = self.filter
         try:
-            self.driver = Driver.objects.get(name=self.filter["Driver"])
-            self.game = Game.objects.get(name=self.filter["GameName"])
-            self.car = self.game.cars.get(name=self.filter["CarModel"])
-            self.track = self.game.tracks.get(name=self.filter["TrackCode"])
+            self.driver = identity_cache.get(Driver, name=filter["Driver"])
+            self.game = identity_cache.get(Game, name=filter["GameName"])
+            self.car = identity_cache.get(Car, game=self.game, name=filter["CarModel"])
+            self.track = identity_cache.get(
+                Track, game=self.game, name=filter["TrackCode"]
+            )
             self.track_length = self.track.length
         except Exception as e:
-            error = f"Error init {self.filter['Driver']} / {self.filter['GameName']}"
-            error += f" / {self.filter['CarModel']}/  {self.filter['TrackCode']} - {e}"
+            error = f"Error init {filter['Driver']} / {filter['GameName']}"
+            error += f" / {filter['CarModel']}/  {filter['TrackCode']} - {e}"
             self.error = error
             logging.error(error)
             return False
 
-        success = self.init_segments()
+        success = self.init_segments(filter)
         if not success:
             return False
 
         self.init_driver()
 
         self.error = None
-        self.telemetry_fields = [
-            "DistanceRoundTrack",
-            "Gear",
-            "SpeedMs",
-            "Throttle",
-            "Brake",
-            "CurrentLapTime",
-        ]
-        self.telemetry = {"_time": []}
-        for field in self.telemetry_fields:
-            self.telemetry[field] = []
+        self.telemetry.clear()
 
         return True
 
     def init_driver(self):
         self.driver_segments = {}
-        self.driver_data = {}
-        fast_lap, created = FastLap.objects.get_or_create(
-            car=self.car, track=self.track, game=self.game, driver=self.driver
-        )
+        self.driver_stats = {}
+        snapshot = fast_lap_cache.get(self.game, self.track, self.car, self.driver)
+        fast_lap = snapshot.fast_lap
+        segments = list(snapshot.segments)
         # check if fast_lap has any fast_lap_segments
-        if not FastLapSegment.objects.filter(fast_lap=fast_lap).exists():
+        if not segments:
             logging.error("no history found for %s", fast_lap)
             # initialize with segments from fast_lap
             for segment in self.segments:
-                FastLapSegment.objects.create(fast_lap=fast_lap, turn=segment.turn)
+                segments.append(
+                    FastLapSegment.objects.create(fast_lap=fast_lap, turn=segment.turn)
+                )
 
-        for segment in FastLapSegment.objects.filter(fast_lap=fast_lap):
+        for segment in segments:
+            # the snapshot is shared, the statistics are applied to a copy
+            segment = copy.copy(segment)
             self.driver_segments[segment.turn] = segment
-            self.driver_data[segment.turn] = {
-                "gear": [],
-                "brake": [],
-            }
+            self.driver_stats[segment.turn] = SegmentStats(segment)
+
+        # measure a pass 20 meters after the end of the segment
+        self.stats_at = {}
+        for segment in self.segments:
+            at = segment.end + 20
+            if self.track_length:
+                at %= self.track_length
+            self.stats_at.setdefault(at, []).append(segment)
+        self.stats_cursor = MessageCursor(
+            dict.fromkeys(self.stats_at, 0), self.track_length
+        )
 
     # def write_cache_to_file(self):
     #     with open("cache.pickle", "wb") as outfile:
@@ -133,50 +172,70 @@ class History:
         return start <= meters <= end
 
     def update(self, time, telemetry):
-        self.telemetry["_time"].append(time)
-        for field in self.telemetry_fields:
-            self.telemetry[field].append(telemetry[field])
-
-    def offset_distance(self, distance, seconds=0.0):
-        if self.fast_lap.data:
-            distance_time = self.fast_lap.data.get("distance_time", {})
-            # check if distance_time is a pandas dataframe
-            if isinstance(distance_time, pd.DataFrame):
-                # check if index at distance exists
-                distance = round(distance)
-                if distance < len(distance_time):
-                    lap_time = distance_time.loc[distance]["CurrentLapTime"]
-                    lap_time_at_offset = lap_time - seconds
-
-                    if lap_time_at_offset < 0:
-                        # FIXME wrap around and start counting back from the end of the track
-                        return 0
-
-                    # loop backwards until we find the first index where CurrentLapTime is smaller than offset
-                    while lap_time > lap_time_at_offset and distance > 0:
-                        distance -= 1
-                        lap_time = distance_time.loc[distance]["CurrentLapTime"]
-        return distance
+        self.telemetry.append(time, telemetry)
+        if self.stats_cursor:
+            for at in self.stats_cursor.due(telemetry["DistanceRoundTrack"]):
+                for segment in self.stats_at[at]:
+                    self.update_segment_stats(segment)
+
+    def update_segment_stats(self, segment):
+        stats = self.driver_stats.get(segment.turn)
+        if stats is None:
+            return
+        values = self.t_segment_stats(segment)
+        if values:
+            stats.add(*values)
+
+    def dirty_driver_segments(self):
+        """Return the driver segments with new passes, with the statistics applied."""
+        segments = []
+        for turn, stats in self.driver_stats.items():
+            if not stats.dirty:
+                continue
+            segment = self.driver_segments.get(turn)
+            if segment is not None and stats.apply(segment):
+                segments.append(segment)
+        return segments
 
     def t_segment(self, start, end):
-        # FIXME: mod track length
-        distance_round_track = self.telemetry["DistanceRoundTrack"]
-        # go back until we have the first index where DistanceRoundTrack is between start and end
-        idx = len(distance_round_track) - 1
-
-        distance = distance_round_track[idx]
+        """Return the first and last index of the latest pass from start to end.
+
+        The indexes are found by binary search in the lap index of the
+        telemetry. A segment with a negative start or an end beyond the track
+        length wraps around the start/finish line.
+        """
+        laps = self.telemetry.laps()
+        if not laps:
+            return 0, 0
+        distance = self.telemetry[TelemetryRingBuffer.DISTANCE]
+
+        wrap = False
+        if self.track_length:
+            if start < 0:
+                start += self.track_length
+                wrap = True
+            elif end > self.track_length:
+                end -= self.track_length
+                wrap = True
+
+        # the latest lap which got past end
+        lap = len(laps) - 1
+        while lap > 0 and distance[laps[lap][1] - 1] < end:
+            lap -= 1
 
         # find the end index where DistanceRoundTrack is smaller than end
-        while distance >= end and idx > 0:
-            idx -= 1
-            distance = distance_round_track[idx]
-        end_idx = idx
+        lap_start, lap_end = laps[lap]
+        idx = np.searchsorted(distance[lap_start:lap_end], end)
+        end_idx = lap_start + max(idx - 1, 0)
 
         # find the start index where DistanceRoundTrack is smaller than start
-        while distance >= start and idx > 0:
-            idx -= 1
-            distance = distance_round_track[idx]
-        start_idx = idx
+        if wrap and lap > 0:
+            # the segment started in the previous lap
+            lap_start, lap_end = laps[lap - 1]
+        else:
+            lap_end = end_idx + 1
+        idx = np.searchsorted(distance[lap_start:lap_end], start)
+        start_idx = lap_start + max(idx - 1, 0)
 
         if start_idx == end_idx:
             if start_idx > 0:
@@ -184,56 +243,78 @@ class History:
             else:
                 end_idx += 1
 
-        return start_idx, end_idx
+        return int(start_idx), int(end_idx)
 
     def t_start_idx(self, start, end, column="Brake"):
         start_idx, end_idx = self.t_segment(start, end)
 
-        idx = start_idx
-        while idx < end_idx:
-            if self.telemetry[column][idx] > 0.001:
-                return idx
-            idx += 1
+        idx = np.flatnonzero(self.telemetry[column][start_idx:end_idx] > 0.001)
+        if idx.size:
+            return start_idx + int(idx[0])
         return start_idx
 
     def t_start_distance(self, start, end, column="Brake"):
         idx = self.t_start_idx(start, end, column)
-        return self.telemetry["DistanceRoundTrack"][idx]
+        return float(self.telemetry["DistanceRoundTrack"][idx])
 
     def t_at_distance(self, meters, column="SpeedMs"):
         start = meters - 1
         end = meters + 1
         start_idx, end_idx = self.t_segment(start, end)
 
-        idx = end_idx
-        distance = self.telemetry["DistanceRoundTrack"][idx]
-        while distance > meters and idx > start_idx:
-            idx -= 1
-            distance = self.telemetry["DistanceRoundTrack"][idx]
+        # the last index up to end_idx where DistanceRoundTrack is not past meters
+        distance_round_track = self.telemetry["DistanceRoundTrack"]
+        idx = np.flatnonzero(distance_round_track[start_idx : end_idx + 1] <= meters)
+        idx = start_idx + int(idx[-1]) if idx.size else start_idx
 
         value = self.telemetry[column][idx]
-        return value
+        return float(value)
+
+    def t_segment_stats(self, segment, brake_ahead=50):
+        """Return the statistics of the latest pass through segment.
+
+        The pass starts brake_ahead meters before the segment. Returns the
+        brake point, the minimum speed, the gear at the minimum speed and the
+        throttle-on point after it, the points are None if the driver did not
+        brake or accelerate. Returns None if the telemetry does not cover the
+        whole pass.
+        """
+        start = segment.start - brake_ahead
+        start_idx, end_idx = self.t_segment(start, segment.end)
+        if end_idx - start_idx < 2:
+            return None
+        window = slice(start_idx, end_idx + 1)
+        distance = self.telemetry["DistanceRoundTrack"][window]
+        if self.track_length:
+            gap = (distance[0] - start) % self.track_length
+            if 10 < gap < self.track_length - 10:
+                return None
+
+        speed = self.telemetry["SpeedMs"][window]
+        low = int(np.argmin(speed))
+        brake = np.flatnonzero(self.telemetry["Brake"][window][: low + 1] > 0.001)
+        throttle = np.flatnonzero(self.telemetry["Throttle"][window][low:] > 0.001)
+        return (
+            float(distance[brake[0]]) if brake.size else None,
+            float(speed[low]),
+            float(self.telemetry["Gear"][window][low]),
+            float(distance[low + throttle[0]]) if throttle.size else None,
+        )
 
     def driver_brake(self, segment):
-        pass
-        # driver_segment = self.driver_segments[segment.turn]
-        # brake = self.driver_brake_start(segment.start - 50, segment.end)
-        # if brake:
-        #     self.driver_data[segment.turn]["brake"].append(brake)
-        #     brake = statistics.median(self.driver_data[segment.turn]["brake"][-5:])
-        #     driver_segment.brake = round(brake)
-        #     driver_segment.save()
-        # return driver_segment.brake
-
-    def init_segments(self) -> bool:
-        """Load the segments from DB."""
-        fast_lap = FastLap.objects.filter(
-            track=self.track, car=self.car, game=self.game
-        ).first()
-        if not fast_lap:
-            self.error = f"no data found for game {self.filter['GameName']}"
-            self.error += f"on track {self.filter['TrackCode']}"
-            self.error += f"in car {self.filter['CarModel']}"
+        """Return the median brake point of the driver in segment."""
+        stats = self.driver_stats.get(segment.turn)
+        if stats is None:
+            return None
+        return stats.brake.value
+
+    def init_segments(self, filter) -> bool:
+        """Load the segments from the fast lap cache."""
+        snapshot = fast_lap_cache.get(self.game, self.track, self.car)
+        if not snapshot:
+            self.error = f"no data found for game {filter['GameName']}"
+            self.error += f"on track {filter['TrackCode']}"
+            self.error += f"in car {filter['CarModel']}"
             return False
 
         logging.debug(
@@ -241,19 +322,18 @@ class History:
         )
 
         self.segments = []
-        for segment in FastLapSegment.objects.filter(fast_lap=fast_lap).order_by(
-            "turn"
-        ):
+        for segment in snapshot.segments:
             self.segments.append(segment)
             logging.debug("segment %s", segment)
 
-        self.fast_lap = fast_lap
+        self.fast_lap = snapshot.fast_lap
+        self.snapshot = snapshot
 
         logging.debug("loaded %s segments", len(self.segments))
 
-        self.error = f"start coaching for game {self.filter['GameName']}"
-        self.error += f"on track {self.filter['TrackCode']}"
-        self.error += f"in car {self.filter['CarModel']}"
+        self.error = f"start coaching for game {filter['GameName']}"
+        self.error += f"on track {filter['TrackCode']}"
+        self.error += f"in car {filter['CarModel']}"
         return True
 
 
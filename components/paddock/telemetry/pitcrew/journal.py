@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+
+
+class LapJournal:
+    """Append-only local journal of finished laps.
+
+    Laps are appended to the journal before they are written to the
+    database and acknowledged afterwards. Records are json lines in segment
+    files named after the sequence number of their first record. `sync`
+    flushes and fsyncs the current segment, so one fsync covers a whole batch.
+    The checkpoint file holds the sequence number up to which all records are
+    acknowledged, segments below the checkpoint are deleted. On startup all
+    records above the checkpoint are loaded again and can be replayed.
+
+    Args:
+        directory (str): directory holding the segments and the checkpoint
+        segment_size (int): number of records per segment
+    """
+
+    CHECKPOINT = "checkpoint"
+
+    def __init__(self, directory, segment_size=1000):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+
+        self.checkpoint = self._read_checkpoint()
+        self.next_seq = self.checkpoint + 1
+        # seq -> record of all records which are not acknowledged yet
+        self.unacked = {}
+        for segment in self._segments():
+            for seq, record in self._read_segment(segment):
+                self.next_seq = max(self.next_seq, seq + 1)
+                if seq > self.checkpoint:
+                    self.unacked[seq] = record
+        if self.unacked:
+            logging.info(f"lap journal: recovered {len(self.unacked)} unsaved laps")
+
+        self._file = None
+        self._segment_count = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _segments(self):
+        """Return the first sequence numbers of all segments in ascending order."""
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".log"):
+                segments.append(int(name[:-4]))
+        return sorted(segments)
+
+    def _segment_name(self, first_seq):
+        return f"{first_seq:012d}.log"
+
+    def _read_segment(self, first_seq):
+        with open(self._path(self._segment_name(first_seq))) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a torn write at the end of the segment
+                    logging.warning(f"lap journal: skipping corrupt entry {line!r}")
+                    continue
+                yield entry["seq"], entry["record"]
+
+    def _read_checkpoint(self):
+        try:
+            with open(self._path(self.CHECKPOINT)) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_checkpoint(self, seq):
+        tmp = self._path(self.CHECKPOINT + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(self.CHECKPOINT))
+        self.checkpoint = seq
+
+    def append(self, record):
+        """Append a record, returns its sequence number. Call sync to make it durable."""
+        if self._file is None or self._segment_count >= self.segment_size:
+            self._roll()
+        seq = self.next_seq
+        self.next_seq += 1
+        self._file.write(json.dumps({"seq": seq, "record": record}) + "\n")
+        self._segment_count += 1
+        self.unacked[seq] = record
+        return seq
+
+    def _roll(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+        self._file = open(self._path(self._segment_name(self.next_seq)), "a")
+        self._segment_count = 0
+
+    def sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def pending(self):
+        """Return (seq, record) of all records which are not acknowledged."""
+        return sorted(self.unacked.items())
+
+    def ack(self, seqs):
+        """Acknowledge records, moves the checkpoint and deletes obsolete segments."""
+        for seq in seqs:
+            self.unacked.pop(seq, None)
+        checkpoint = min(self.unacked) - 1 if self.unacked else self.next_seq - 1
+        if checkpoint > self.checkpoint:
+            self._write_checkpoint(checkpoint)
+            self.compact()
+
+    def compact(self):
+        """Delete all segments which only hold acknowledged records."""
+        segments = self._segments()
+        # a segment ends right before the next one starts, the last one is still open
+        for first_seq, next_first_seq in zip(segments, segments[1:]):
+            if next_first_seq - 1 <= self.checkpoint:
+                os.remove(self._path(self._segment_name(first_seq)))
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
@@ -0,0 +1,96 @@
+import bisect
+
+
+class MessageCursor:
+    """Find the messages which are due at the distance of the driver.
+
+    A message is due once the car crossed its trigger point, which is the
+    distance the car covers in the lead time of the message at its current
+    speed before the message. The messages are visited in the order of
+    their distance and the cursor only moves forward within a lap, so a
+    message is not skipped when the car moves several meters per tick or
+    ticks are dropped, and a tick only looks at the messages which are due.
+
+    When the distance drops by more than lap_reset meters a new lap started.
+    If the car crossed the start/finish line the messages it passed at the
+    end of the previous lap and at the start of the new one are due, else
+    (e.g. on the first tick or after a reset to the pits) the cursor is moved
+    to the first message ahead by binary search. Towards the end of a lap
+    the messages at the start of the next lap are due as soon as their
+    trigger point is crossed.
+
+    Args:
+        positions (dict): the distances of the messages -> their lead time in seconds
+        length (float): the length of the lap in meters
+        window (float): meters before its trigger point a message is due
+        lap_reset (float): distance drop in meters which starts a new lap
+    """
+
+    def __init__(self, positions, length=0, window=1, lap_reset=100):
+        self.positions = sorted(positions)
+        self.leads = [positions[at] for at in self.positions]
+        self.length = length
+        self.window = window
+        self.lap_reset = lap_reset
+        self.distance = None
+        # index of the next message of the lap
+        self.next = 0
+        # number of messages of the next lap which were due already
+        self.wrapped = 0
+        # index of the next message of the previous lap which was passed
+        self.behind = len(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def crossed_line(self, distance):
+        """Return if the car got from the previous distance to distance across the start/finish line."""
+        if self.distance is None or not self.length:
+            return False
+        return self.length - self.distance + distance <= self.lap_reset
+
+    def due(self, distance, speed=0.0):
+        """Yield the distances of the messages which are due, in order.
+
+        A message is done once it is yielded, the messages left when the
+        caller stops iterating stay due for the next tick.
+
+        Args:
+            distance (float): the distance into the lap in meters
+            speed (float): the speed in meters per second
+        """
+        positions = self.positions
+        count = len(positions)
+        if self.distance is None or distance < self.distance - self.lap_reset:
+            if self.crossed_line(distance):
+                # the rest of the previous lap was passed
+                self.behind = self.next
+                self.next = self.wrapped
+            else:
+                self.behind = count
+                start = bisect.bisect_left(positions, distance - self.window)
+                self.next = max(start, self.wrapped)
+            self.wrapped = 0
+        self.distance = distance
+
+        while self.behind < count:
+            self.behind += 1
+            yield positions[self.behind - 1]
+
+        leads = self.leads
+        reach = distance + self.window
+        while self.next < count:
+            at = positions[self.next]
+            if at - speed * leads[self.next] > reach:
+                return
+            self.next += 1
+            yield at
+
+        if not self.length:
+            return
+        while self.wrapped < count:
+            at = positions[self.wrapped]
+            if at + self.length - speed * leads[self.wrapped] > reach:
+                return
+            self.wrapped += 1
+            yield at
@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import types
+from typing import NamedTuple
+
+from .message_cursor import MessageCursor
+
+# seconds from publishing a spoken message until the driver hears it
+B4MAD_RACING_COACH_LEAD_TIME = float(
+    os.environ.get("B4MAD_RACING_COACH_LEAD_TIME", 0.5)
+)
+
+
+class PlannedMessage(NamedTuple):
+    """A message of a plan, at its resolved distance.
+
+    Text and JSON messages are sent as payload, for an evaluation fn is the
+    name of the Coach method called with args and kwargs.
+    """
+
+    at: int
+    msg: object
+    payload: bytes
+    # seconds to respond before the car is at the message
+    lead: float
+    segment: object
+    fn: str = None
+    args: tuple = ()
+    kwargs: dict = None
+
+
+class MessagePlan:
+    """The messages of a coach for one fast lap, keyed by their distance.
+
+    Plans are immutable and shared between the coaches of all drivers on the
+    same fast lap, the state of a coach (when a message was read, which
+    messages are disabled) is kept by the coach.
+
+    Args:
+        messages (iterable): the PlannedMessage of the plan
+        track_length (int): the length of the track in meters
+    """
+
+    def __init__(self, messages, track_length):
+        messages = sorted(messages, key=lambda message: message.at)
+        self.messages = types.MappingProxyType({m.at: m for m in messages})
+        self.leads = types.MappingProxyType({m.at: m.lead for m in messages})
+        self.track_length = track_length
+
+    def __len__(self):
+        return len(self.messages)
+
+    def cursor(self):
+        """Return a new cursor over the messages."""
+        return MessageCursor(self.leads, self.track_length)
+
+
+class MessagePlanBuilder:
+    """Compile the messages of a coach from the segments of a fast lap.
+
+    Args:
+        track_length (int): the length of the track in meters
+        profile (FastLapProfile): the profile to start messages early enough
+            to finish reading them by their distance, or None
+        json_response (bool): send JSON payloads instead of text
+        lead_time (float): the lead time of text messages in seconds
+    """
+
+    def __init__(
+        self,
+        track_length,
+        profile=None,
+        json_response=False,
+        lead_time=B4MAD_RACING_COACH_LEAD_TIME,
+    ):
+        self.track_length = track_length
+        self.profile = profile
+        self.json_response = json_response
+        self.lead_time = lead_time
+        self.messages = {}
+
+    def build(self):
+        return MessagePlan(self.messages.values(), self.track_length)
+
+    def add_segments(self, segments):
+        for segment in segments:
+            if segment.mark == "brake":
+                gear = ""
+                if segment.gear:
+                    gear = f"gear {segment.gear} "
+                text = gear + "%s percent" % (round(segment.force / 10) * 10)
+                at = segment.start
+                self.new_msg_done_by(at, text, segment)
+
+                at = segment.start
+                text = "brake"
+                msg = self.schedule_msg(at, text, segment)
+                # msg = self.new_msg(at, text, segment)
+
+                at = segment.end + 20
+                self.new_fn(at, "eval_brake", segment, brake_msg_at=msg.at)
+
+            if segment.mark == "throttle":
+                at = segment.start - 100
+                to = round(segment.force / 10) * 10
+                text = "throttle to %s" % to
+                self.new_msg_done_by(at, text, segment)
+
+                at = segment.start
+                text = "now"
+                self.schedule_msg(at, text, segment)
+                # self.new_msg(at, text, segment)
+
+            # if segment.gear:
+            #     at = segment.start - 80
+            #     text = f"gear {segment.gear}"
+            #     self.new_msg(at, text, segment)
+
+            #     at = segment.end + 60
+            #     self.new_fn(at, "eval_gear", segment)
+
+    def msg_read_time(self, msg):
+        # count the number of words
+        words = len(msg.split(" "))
+        return words * 0.8  # avg ms per word
+
+    def offset_distance(self, distance, seconds=0.0):
+        """Return where the fast lap was seconds before it reached distance."""
+        if self.profile is None:
+            return distance
+        return round(float(self.profile.offset_distance(distance, seconds)))
+
+    def place(self, at, msg=None, finish_reading_at=False):
+        """Return the free distance to schedule a message for at."""
+        at = at % self.track_length
+
+        # there's a delay of x seconds to read the message at the requested meters
+        # offset = 1.0  # time_delta 0.1
+        offset = 1.1
+        offset = 0
+
+        # if the message should be finished at the requested meters
+        if finish_reading_at:
+            read_time = self.msg_read_time(msg)
+            offset += read_time
+
+        if offset:
+            new_at = self.offset_distance(at, seconds=offset)
+            logging.debug(f"offset {offset:.2f} seconds: {at} -> {new_at}")
+            at = new_at
+        while at in self.messages:
+            at += 1
+            at = at % self.track_length
+        return at
+
+    def new_msg(self, at, msg, segment, finish_reading_at=False):
+        at = self.place(at, msg, finish_reading_at)
+        if isinstance(msg, dict):
+            payload = json.dumps(msg).encode()
+            lead = 0
+        else:
+            payload = msg.encode()
+            lead = self.lead_time
+        message = PlannedMessage(at, msg, payload, lead, segment)
+        self.messages[at] = message
+        return message
+
+    def new_msg_done_by(self, at, msg, segment):
+        return self.new_msg(at, msg, segment, finish_reading_at=True)
+
+    def schedule_msg(self, at, msg, segment):
+        if self.json_response:
+            respond_at = at - 50
+            payload = {
+                "message": msg,
+                "distance": at,
+                "priority": 9,
+            }
+            return self.new_msg(respond_at, payload, segment)
+        else:
+            return self.new_msg(at, msg, segment)
+
+    def new_fn(self, at, fn, segment, **kwargs):
+        at = self.place(at)
+        message = PlannedMessage(at, fn, None, 0, segment, fn, (segment,), kwargs)
+        self.messages[at] = message
+        return message
+
+
+def get_plan(
+    snapshot, track_length, json_response=False, lead_time=B4MAD_RACING_COACH_LEAD_TIME
+):
+    """Return the message plan of a fast lap snapshot, compiled once per snapshot.
+
+    A new version of the fast lap comes with a new snapshot and so with a
+    new plan.
+
+    Args:
+        snapshot (FastLapSnapshot): the fast lap and its segments
+        track_length (int): the length of the track in meters
+        json_response (bool): send JSON payloads instead of text
+        lead_time (float): the lead time of text messages in seconds
+    """
+    key = (track_length, json_response, lead_time)
+    plan = snapshot.plans.get(key)
+    if plan is None:
+        builder = MessagePlanBuilder(
+            track_length, snapshot.profile, json_response, lead_time
+        )
+        builder.add_segments(snapshot.segments)
+        plan = snapshot.plans.setdefault(key, builder.build())
+    return plan
@@ -0,0 +1,272 @@
+import bisect
+import threading
+
+# the stages of a coached tick
+BROKER = "broker"  # client timestamp until received from the broker
+DECODE = "decode"  # decoding the payload
+QUEUE = "queue"  # received until the coach worker picks it up
+HISTORY = "history"  # History.update
+DELTA = "delta"  # LapDelta.update
+LOOKUP = "lookup"  # finding and evaluating the due messages of the coach
+PUBLISH = "publish"  # handing the response to the MQTT client
+TOTAL = "total"  # client timestamp until the response is published
+READY = "ready"  # first message of a session until its coach is ready
+
+
+class Histogram:
+    """Counts of observed durations in fixed buckets of seconds.
+
+    Bucket i counts the values up to buckets[i], the last one the values
+    above all buckets. observe does not lock, under the GIL an update lost
+    to a concurrent observe is accepted for the lower overhead.
+
+    Args:
+        buckets (tuple): the sorted upper bounds of the buckets
+    """
+
+    BUCKETS = (
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+    )
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, snapshot):
+        counts, total, count = snapshot
+        for i, value in enumerate(counts):
+            self.counts[i] += value
+        self.sum += total
+        self.count += count
+
+    def snapshot(self):
+        return (list(self.counts), self.sum, self.count)
+
+
+class LatencyMetrics:
+    """Latency histograms of the stages of the coaching hot path.
+
+    Every stage is recorded in a histogram of all drivers and, if a driver
+    is given, in a histogram of the driver.
+    """
+
+    # stage -> buckets of the stages which take longer than a tick
+    STAGE_BUCKETS = {
+        READY: (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0),
+    }
+
+    def __init__(self):
+        # stage -> Histogram
+        self.stages = {}
+        # driver -> stage -> Histogram
+        self.drivers = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, stage, driver=None):
+        histograms = self.stages
+        if driver is not None:
+            histograms = self.drivers.get(driver)
+            if histograms is None:
+                with self._lock:
+                    histograms = self.drivers.setdefault(driver, {})
+        histogram = histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = histograms.setdefault(
+                    stage, Histogram(self.STAGE_BUCKETS.get(stage, Histogram.BUCKETS))
+                )
+        return histogram
+
+    def observe(self, stage, seconds, driver=None):
+        self.histogram(stage).observe(seconds)
+        if driver is not None:
+            self.histogram(stage, driver).observe(seconds)
+
+    def remove_driver(self, driver):
+        with self._lock:
+            self.drivers.pop(driver, None)
+
+    def clear(self):
+        with self._lock:
+            self.stages = {}
+            self.drivers = {}
+
+    def snapshot(self):
+        """Return the counts as plain data, e.g. to send them to another process."""
+        with self._lock:
+            stages = dict(self.stages)
+            drivers = {driver: dict(stages) for driver, stages in self.drivers.items()}
+        return {
+            "stages": {stage: h.snapshot() for stage, h in stages.items()},
+            "drivers": {
+                driver: {stage: h.snapshot() for stage, h in histograms.items()}
+                for driver, histograms in drivers.items()
+            },
+        }
+
+    def merge(self, snapshot):
+        for stage, counts in snapshot["stages"].items():
+            self.histogram(stage).merge(counts)
+        for driver, histograms in snapshot["drivers"].items():
+            for stage, counts in histograms.items():
+                self.histogram(stage, driver).merge(counts)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+def _render_histogram(lines, name, histogram, **labels):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{{{_labels(**labels, le=bound)}}} {cumulative}")
+    lines.append(f'{name}_bucket{{{_labels(**labels, le="+Inf")}}} {histogram.count}')
+    lines.append(f"{name}_sum{{{_labels(**labels)}}} {histogram.sum}")
+    lines.append(f"{name}_count{{{_labels(**labels)}}} {histogram.count}")
+
+
+def render(snapshots):
+    """Return the merged snapshots in the Prometheus text format."""
+    merged = LatencyMetrics()
+    for snapshot in snapshots:
+        merged.merge(snapshot)
+
+    lines = [
+        "# HELP pitcrew_stage_seconds latency of the coaching stages of all drivers",
+        "# TYPE pitcrew_stage_seconds histogram",
+    ]
+    for stage, histogram in sorted(merged.stages.items()):
+        _render_histogram(lines, "pitcrew_stage_seconds", histogram, stage=stage)
+
+    lines.append(
+        "# HELP pitcrew_driver_stage_seconds latency of the coaching stages per driver"
+    )
+    lines.append("# TYPE pitcrew_driver_stage_seconds histogram")
+    for driver, histograms in sorted(merged.drivers.items()):
+        for stage, histogram in sorted(histograms.items()):
+            _render_histogram(
+                lines,
+                "pitcrew_driver_stage_seconds",
+                histogram,
+                driver=driver,
+                stage=stage,
+            )
+    return "\n".join(lines) + "\n"
+
+
+# stats key of a coach worker -> (metric, type, help, scale)
+WORKER_GAUGES = {
+    "coaches": ("pitcrew_coach_worker_coaches", "gauge", "active coaches", 1),
+    "depth": ("pitcrew_coach_worker_queue_depth", "gauge", "queued ticks", 1),
+    "dropped": (
+        "pitcrew_coach_worker_dropped_total",
+        "counter",
+        "ticks dropped because the queue was full",
+        1,
+    ),
+    "ticks": ("pitcrew_coach_worker_ticks_total", "counter", "processed ticks", 1),
+    "avg_latency_ms": (
+        "pitcrew_coach_worker_tick_latency_avg_seconds",
+        "gauge",
+        "average tick latency",
+        0.001,
+    ),
+    "max_latency_ms": (
+        "pitcrew_coach_worker_tick_latency_max_seconds",
+        "gauge",
+        "maximum tick latency",
+        0.001,
+    ),
+}
+
+# stats key of a firehose worker queue -> (metric, type, help, scale)
+FIREHOSE_GAUGES = {
+    "depth": ("pitcrew_firehose_queue_depth", "gauge", "queued messages", 1),
+    "max_depth": (
+        "pitcrew_firehose_queue_max_depth",
+        "gauge",
+        "maximum number of queued messages",
+        1,
+    ),
+    "dropped": (
+        "pitcrew_firehose_queue_dropped_total",
+        "counter",
+        "messages dropped because the queue was full",
+        1,
+    ),
+}
+
+# stats key of the telemetry decoder -> (metric, type, help, scale)
+DECODER_GAUGES = {
+    "count": ("pitcrew_firehose_decoded_total", "counter", "decoded payloads", 1),
+    "errors": (
+        "pitcrew_firehose_decode_errors_total",
+        "counter",
+        "payloads which could not be decoded",
+        1,
+    ),
+}
+
+
+def render_gauges(stats, gauges, label, owner):
+    """Return stats as gauges in the Prometheus text format.
+
+    Args:
+        stats (list): a dict of the values of every owner
+        gauges (dict): the key of a value -> (metric, type, help, scale)
+        label (str): the key of the value which labels the owner
+        owner (str): the kind of owner, for the help text
+    """
+    lines = []
+    for key, (name, kind, text, scale) in gauges.items():
+        lines.append(f"# HELP {name} {text} per {owner}")
+        lines.append(f"# TYPE {name} {kind}")
+        for values in stats:
+            labels = _labels(**{label: values[label]})
+            lines.append(f"{name}{{{labels}}} {values[key] * scale}")
+    return "\n".join(lines) + "\n"
+
+
+def render_workers(stats):
+    """Return the stats of the coach workers as gauges in the Prometheus text format."""
+    return render_gauges(stats, WORKER_GAUGES, "worker", "coach worker")
+
+
+def render_queues(stats):
+    """Return the stats of the firehose worker queues as gauges in the Prometheus text format."""
+    return render_gauges(stats, FIREHOSE_GAUGES, "worker", "firehose worker")
+
+
+def render_decoder(stats):
+    """Return the counters of the telemetry decoder in the Prometheus text format."""
+    return render_gauges([stats], DECODER_GAUGES, "backend", "decoder backend")
+
+
+metrics = LatencyMetrics()
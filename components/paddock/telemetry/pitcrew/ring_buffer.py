@@ -0,0 +1,104 @@
+import collections
+
+import numpy as np
+
+
+class TelemetryRingBuffer:
+    """Fixed-size, column-oriented buffer of the latest telemetry.
+
+    Every column is a float32 array of twice the capacity and each value is
+    written twice, at pos and pos + capacity. The latest `capacity` values of
+    a column are therefore always a contiguous slice, so `column` returns a
+    view in chronological order without copying and `append` allocates
+    nothing. Indexes into a column are relative to the oldest buffered value.
+
+    The `_time` column holds the seconds since the first appended tick.
+
+    If a distance field is given the buffer also keeps a lap index: a new lap
+    starts when the distance drops by more than `lap_reset` meters and the
+    `_distance` column holds the maximum distance of the lap so far. That
+    column never decreases within a lap, so it can be binary searched.
+
+    Args:
+        fields (list): the telemetry fields to buffer
+        capacity (int): number of ticks to keep
+        distance (str): the field with the distance into the lap
+        lap_reset (float): distance drop in meters which starts a new lap
+    """
+
+    TIME = "_time"
+    DISTANCE = "_distance"
+
+    def __init__(self, fields, capacity=12000, distance=None, lap_reset=100):
+        self.fields = list(fields)
+        self.capacity = capacity
+        self.columns = {self.TIME: 0}
+        for i, field in enumerate(self.fields, 1):
+            self.columns[field] = i
+        self.distance = distance
+        if distance:
+            self.columns[self.DISTANCE] = len(self.columns)
+        self.lap_reset = lap_reset
+        self.lap_distance = None
+        # tick numbers of the starts of the laps in the buffer
+        self.lap_starts = collections.deque()
+        self.data = np.zeros((len(self.columns), 2 * capacity), dtype=np.float32)
+        # number of ticks appended since the start
+        self.count = 0
+        self.start = None
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, time, telemetry):
+        """Append a tick, telemetry must contain all fields."""
+        if self.start is None:
+            self.start = time
+        pos = self.count % self.capacity
+        data = self.data
+        mirror = pos + self.capacity
+        data[0, pos] = data[0, mirror] = time - self.start
+        for i, field in enumerate(self.fields, 1):
+            data[i, pos] = data[i, mirror] = telemetry[field]
+        if self.distance:
+            self._index_lap(telemetry[self.distance], pos, mirror)
+        self.count += 1
+
+    def _index_lap(self, distance, pos, mirror):
+        if self.lap_distance is None or distance < self.lap_distance - self.lap_reset:
+            self.lap_starts.append(self.count)
+            self.lap_distance = distance
+        elif distance > self.lap_distance:
+            self.lap_distance = distance
+        # forget the laps which left the buffer
+        oldest = self.count + 1 - self.capacity
+        if len(self.lap_starts) > 1 and self.lap_starts[1] <= oldest:
+            self.lap_starts.popleft()
+        column = self.columns[self.DISTANCE]
+        self.data[column, pos] = self.data[column, mirror] = self.lap_distance
+
+    def laps(self):
+        """Return the start and end (exclusive) index of every buffered lap, oldest first."""
+        offset = self.count - len(self)
+        starts = list(self.lap_starts) + [self.count]
+        return [
+            (max(start - offset, 0), end - offset)
+            for start, end in zip(starts, starts[1:])
+        ]
+
+    def column(self, field):
+        """Return the buffered values of field, oldest first, as a view."""
+        row = self.data[self.columns[field]]
+        if self.count <= self.capacity:
+            return row[: self.count]
+        pos = self.count % self.capacity
+        return row[pos : pos + self.capacity]
+
+    def __getitem__(self, field):
+        return self.column(field)
+
+    def clear(self):
+        self.count = 0
+        self.start = None
+        self.lap_distance = None
+        self.lap_starts.clear()
@@ -0,0 +1,162 @@
+class Ema:
+    """Exponential moving average.
+
+    Args:
+        alpha (float): the weight of a new value
+    """
+
+    __slots__ = ("alpha", "value")
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.value = None
+
+    def add(self, value):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+
+
+class P2Quantile:
+    """Streaming quantile estimate with the P² algorithm of Jain and Chlamtac.
+
+    Keeps five markers instead of the values, the markers are moved towards
+    their desired positions with a piecewise parabolic interpolation. Until
+    five values were added the quantile of those values is returned.
+
+    Args:
+        q (float): the quantile, 0.5 for the median
+    """
+
+    __slots__ = ("q", "heights", "positions", "desired", "increments")
+
+    def __init__(self, q=0.5):
+        self.q = q
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5]
+        self.increments = [0, q / 2, q, (1 + q) / 2, 1]
+
+    @property
+    def value(self):
+        heights = self.heights
+        if not heights:
+            return None
+        if len(heights) < 5:
+            ordered = sorted(heights)
+            return ordered[min(int(len(ordered) * self.q), len(ordered) - 1)]
+        return heights[2]
+
+    def add(self, value):
+        heights = self.heights
+        if len(heights) < 5:
+            heights.append(value)
+            if len(heights) == 5:
+                heights.sort()
+            return
+
+        # the cell of the value, extending the extreme markers if needed
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+
+        positions = self.positions
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # adjust the three middle markers
+        for i in range(1, 4):
+            offset = self.desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or (
+                offset <= -1 and positions[i - 1] - positions[i] < -1
+            ):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, step)
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i, step):
+        heights = self.heights
+        positions = self.positions
+        return heights[i] + step / (positions[i + 1] - positions[i - 1]) * (
+            (positions[i] - positions[i - 1] + step)
+            * (heights[i + 1] - heights[i])
+            / (positions[i + 1] - positions[i])
+            + (positions[i + 1] - positions[i] - step)
+            * (heights[i] - heights[i - 1])
+            / (positions[i] - positions[i - 1])
+        )
+
+    def _linear(self, i, step):
+        heights = self.heights
+        positions = self.positions
+        return heights[i] + step * (heights[i + step] - heights[i]) / (
+            positions[i + step] - positions[i]
+        )
+
+
+class SegmentStats:
+    """Statistics of the passes of a driver through a segment, in constant memory.
+
+    The brake point, the gear and the throttle-on point are medians, the
+    minimum speed is a moving average. The values stored in the driver
+    segment, e.g. of an earlier session, are the first observation.
+
+    Args:
+        segment (FastLapSegment): the segment of the driver
+        alpha (float): the weight of a new minimum speed
+    """
+
+    # the fields of FastLapSegment written by apply
+    fields = ["brake", "speed", "gear", "accelerate"]
+
+    def __init__(self, segment=None, alpha=0.2):
+        self.brake = P2Quantile(0.5)
+        self.speed = Ema(alpha)
+        self.gear = P2Quantile(0.5)
+        self.accelerate = P2Quantile(0.5)
+        self.passes = 0
+        # added passes which were not applied yet
+        self.dirty = False
+        if segment is not None:
+            for field in self.fields:
+                value = getattr(segment, field)
+                if value:
+                    getattr(self, field).add(value)
+
+    def add(self, brake, speed, gear, accelerate):
+        """Add a pass, brake and accelerate are None if the driver did not brake or accelerate."""
+        if brake is not None:
+            self.brake.add(brake)
+        self.speed.add(speed)
+        self.gear.add(gear)
+        if accelerate is not None:
+            self.accelerate.add(accelerate)
+        self.passes += 1
+        self.dirty = True
+
+    def apply(self, segment):
+        """Write the statistics to the fields of segment, return if one changed."""
+        changed = False
+        for field in self.fields:
+            value = getattr(self, field).value
+            if value is None:
+                continue
+            value = round(value)
+            if getattr(segment, field) != value:
+                setattr(segment, field, value)
+                changed = True
+        self.dirty = False
+        return changed
@@ -1,13 +1,113 @@
-import django.utils.timezone
+import datetime
+import enum
 import logging
 from telemetry.models import Game
 
+from .clock import WallClock
+
+
+class LapState(enum.IntEnum):
+    # waiting for the lap time to start
+    WAITING = 0
+    # measuring the lap time
+    MEASURING = 1
+    # stopped measuring, e.g. after a reset or a jump on track
+    INACTIVE = 2
+    # crossed the finish line
+    FINISHED = 3
+
+
+# events emitted by a session
+SESSION_CREATED = "session_created"
+LAP_FINISHED = "lap_finished"
+
+
+class Lap:
+    __slots__ = ("start", "end", "number", "length", "time", "valid", "state", "saved")
+
+    def __init__(self, now, number=-1, length=-1, time=-1, state=LapState.WAITING):
+        self.start = now
+        self.end = now
+        self.number = number
+        self.length = length
+        self.time = time
+        self.valid = False
+        self.state = state
+        # set by the session saver once the lap is persisted
+        self.saved = False
+
+    @property
+    def finished(self):
+        return self.state == LapState.FINISHED
+
+    def to_dict(self):
+        return {
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "number": self.number,
+            "length": self.length,
+            "time": self.time,
+            "valid": self.valid,
+            "state": int(self.state),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        lap = cls(
+            datetime.datetime.fromisoformat(state["start"]),
+            number=state["number"],
+            length=state["length"],
+            time=state["time"],
+            state=LapState(state["state"]),
+        )
+        lap.end = datetime.datetime.fromisoformat(state["end"])
+        lap.valid = state["valid"]
+        return lap
+
 
 class Session:
-    def __init__(self, id):
+    __slots__ = (
+        "id",
+        "start",
+        "end",
+        "laps",
+        "driver",
+        "session_id",
+        "game",
+        "game_name",
+        "track",
+        "car",
+        "session_type",
+        "record",
+        "current_lap_time",
+        "distance_round_track",
+        "current_lap",
+        "inactive_log_time",
+        "clock",
+        "touched",
+        "events",
+    )
+
+    # telemetry fields read by analyze and analyze_iracing
+    fields = [
+        "CurrentLap",
+        "CurrentLapIsValid",
+        "CurrentLapTime",
+        "DistanceRoundTrack",
+        "LapTimePrevious",
+        "PreviousLapWasValid",
+        "SpeedMs",
+    ]
+
+    def __init__(self, id, clock=None, timestamp=None):
         self.id = id
-        self.start = django.utils.timezone.now()
+        self.clock = clock or WallClock()
+        self.start = self.clock.now(timestamp)
         self.end = self.start
+        # server time (seconds since the epoch) of the last signal, used to expire the session
+        self.touched = 0.0
+        # queue receiving (event, session, lap) tuples
+        self.events = None
         self.laps = []
         self.driver = ""
         self.session_id = ""
@@ -21,32 +121,93 @@ class Session:
         self.current_lap_time = -1
         self.distance_round_track = 1_000_000_000
         self.current_lap = -1
+        self.inactive_log_time = self.start
+
+    def to_dict(self):
+        """Return the state of the session and its unsaved laps as a json serializable dict."""
+        laps = [lap.to_dict() for lap in self.laps if not lap.saved]
+        return {
+            "id": self.id,
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "laps": laps,
+            "driver": str(self.driver),
+            "session_id": self.session_id,
+            "game_name": self.game_name,
+            "track": str(self.track),
+            "car": str(self.car),
+            "session_type": str(self.session_type),
+            "current_lap_time": self.current_lap_time,
+            "distance_round_track": self.distance_round_track,
+            "current_lap": self.current_lap,
+        }
+
+    @classmethod
+    def from_dict(cls, state, clock=None):
+        """Create a session from the state returned by to_dict."""
+        session = cls(state["id"], clock=clock)
+        for key in [
+            "driver",
+            "session_id",
+            "game_name",
+            "track",
+            "car",
+            "session_type",
+            "current_lap_time",
+            "distance_round_track",
+            "current_lap",
+        ]:
+            setattr(session, key, state[key])
+        session.start = datetime.datetime.fromisoformat(state["start"])
+        session.end = datetime.datetime.fromisoformat(state["end"])
+        session.laps = [Lap.from_dict(lap) for lap in state["laps"]]
+        return session
+
+    def emit(self, event, lap=None):
+        if self.events is not None:
+            self.events.put((event, self, lap))
 
-    def signal(self, telemetry):
-        now = django.utils.timezone.now()
+    def signal(self, telemetry, timestamp=None):
+        now = self.clock.now(timestamp)
         self.end = now
         if self.game_name == "iRacing":
             self.analyze_iracing(telemetry, now)
         else:
             self.analyze(telemetry, now)
 
+    def prune_laps(self, max_laps=None):
+        """Delete the laps which are saved already and the oldest laps above max_laps.
+
+        The two most recent laps are kept, they are still used by analyze.
+        Above max_laps only laps which were not finished are dropped, they
+        are never saved. Finished laps are kept until the session saver
+        saved them.
+        """
+        # delete in place, the laps list is appended to by the firehose workers
+        for i in range(len(self.laps) - 3, -1, -1):
+            if self.laps[i].saved:
+                del self.laps[i]
+        if max_laps and len(self.laps) > max_laps:
+            drop = [i for i in range(len(self.laps) - 2) if not self.laps[i].finished][
+                : len(self.laps) - max_laps
+            ]
+            for i in reversed(drop):
+                del self.laps[i]
+            if drop:
+                logging.info(
+                    f"{self.session_id}\n\t dropped {len(drop)} unfinished laps"
+                    + f", keeping {len(self.laps)} laps until they are saved"
+                )
+
     def log_laps(self):
         for lap in self.laps:
             logging.debug(
-                f"{self.driver} lap {lap['number']:02d}: {lap['time']}"
-                + f" - valid: {lap['valid']} - finished: {lap['finished']}"
+                f"{self.driver} lap {lap.number:02d}: {lap.time}"
+                + f" - valid: {lap.valid} - finished: {lap.finished}"
             )
 
-    def new_lap(self, now):
-        lap = {
-            "start": now,
-            "end": now,
-            "number": -1,
-            "length": -1,
-            "time": -1,
-            "finished": False,
-            "valid": False,
-        }
+    def new_lap(self, now, **kwargs):
+        lap = Lap(now, **kwargs)
         self.laps.append(lap)
         return lap
 
@@ -54,10 +215,9 @@ class Session:
         current_lap = int(telemetry.get("CurrentLap", -1))
         # start a new lap if current_lap increases
         if current_lap > self.current_lap:
-            lap = self.new_lap(now)
-            lap["number"] = current_lap
+            lap = self.new_lap(now, number=current_lap)
             self.current_lap = current_lap
-            logging.debug(f"{self.driver} new lap: {lap['number']}")
+            logging.debug(f"{self.driver} new lap: {lap.number}")
 
         lap = self.laps[-1]
         previous_lap = self.laps[-2] if len(self.laps) > 1 else None
@@ -67,19 +227,20 @@ class Session:
 
         # its an outlap if CurrentLapTime is 0
 
-        lap["end"] = now
-        lap["length"] = telemetry.get("DistanceRoundTrack", -1)
-        lap["valid"] = current_lap_is_valid
+        lap.end = now
+        lap.length = telemetry.get("DistanceRoundTrack", -1)
+        lap.valid = current_lap_is_valid
 
         if lap_time_previous > 0 and previous_lap:
-            if lap_time_previous != previous_lap["time"]:
+            if lap_time_previous != previous_lap.time:
                 logging.debug(
                     f"{self.driver} setting previous lap time from"
-                    + f"{previous_lap['time']} to {lap_time_previous}"
+                    + f"{previous_lap.time} to {lap_time_previous}"
                 )
-                previous_lap["time"] = lap_time_previous
-                previous_lap["valid"] = telemetry.get("PreviousLapWasValid", False)
-                previous_lap["finished"] = True
+                previous_lap.time = lap_time_previous
+                previous_lap.valid = telemetry.get("PreviousLapWasValid", False)
+                previous_lap.state = LapState.FINISHED
+                self.emit(LAP_FINISHED, previous_lap)
                 self.log_laps()
 
     def analyze(self, telemetry, now):
@@ -96,88 +257,73 @@ class Session:
             return
 
         threshold = speed * 0.5
-        new_lap = False
-        previous_length = -1
-        if len(self.laps) == 0:
+        laps = self.laps
+        if not laps:
             #  start a new lap if
             #  * DistanceOnTrack starts at 0 # we drive over the finish line
             #    we're sampling a 60hz, with the speed we should see a lap start
             #      (speed * 0.16) meters past the finish line
             if length < threshold:
-                new_lap = True
-        else:
-            lap = self.laps[-1]
-            previous_length = lap["length"]
-            # start a new lap if cross the finish line
-            if length < threshold and length < lap["length"]:
-                logging.info(
-                    f"{self.session_id}\n\t finishing lap at length {previous_length}"
-                    + f" and time {lap['time']}"
-                )
-                lap["finished"] = True
-                new_lap = True
-
-        if new_lap:
-            lap = {
-                "start": now,
-                "end": now,
-                "length": length,
-                "time": lap_time,
-                "finished": False,
-                "number": current_lap,
-                # if time is less than 5 seconds, lap is active
-                "active": lap_time < 5,
-                "inactive_log_time": now,
-                "valid": False,
-            }
-            self.laps.append(lap)
+                self.start_lap(now, length, lap_time, current_lap, threshold, -1)
+            return
+
+        lap = laps[-1]
+        # start a new lap if cross the finish line
+        if length < threshold and length < lap.length:
             logging.info(
-                f"{self.session_id}\n\t new lap length {length} < threshold {threshold}"
-                + f" and < previous lap length {previous_length}, active: {lap['active']}, time: {lap_time}"
+                f"{self.session_id}\n\t finishing lap at length {lap.length}"
+                + f" and time {lap.time}"
             )
+            lap.state = LapState.FINISHED
+            self.emit(LAP_FINISHED, lap)
+            self.start_lap(now, length, lap_time, current_lap, threshold, lap.length)
             return
 
-        if len(self.laps) > 0:
-            lap = self.laps[-1]
-
-            if lap["active"]:
-                # mark not active if we jump back more than 50 meters
-                distance_since_previous_tick = length - lap["length"]
-                if distance_since_previous_tick < -50:
-                    logging.info(
-                        f"{self.session_id}\n\t lap not active, jump {distance_since_previous_tick}m\n"
-                        + f"\t\t lap length {lap['length']} jumped to length {length}"
-                    )
-                    lap["active"] = False
-                    return
-
-                # FIXME mark not active if we cut the track
-
-                previous_lap_time = lap["time"]
-                if lap_time < previous_lap_time:
-                    logging.info(
-                        f"{self.session_id}\n\t stop measuring time at {lap_time}s for {previous_lap_time}s / {length}m"
-                    )
-                    lap["active"] = False
-                else:
-                    lap["end"] = now
-                    lap["length"] = length
-                    lap["time"] = lap_time
-            elif (lap_time < lap["time"] or lap_time == 0) and lap["start"] == lap[
-                "end"
-            ]:
-                # start measuring time if we're past the threshold and the time started
-                #  some games have a delay on CurrentLapTime
+        state = lap.state
+        if state == LapState.MEASURING:
+            # mark not active if we jump back more than 50 meters
+            distance_since_previous_tick = length - lap.length
+            if distance_since_previous_tick < -50:
                 logging.info(
-                    f"{self.session_id}\n\t start measuring time at lap.time {lap['time']} / time {lap_time}"
+                    f"{self.session_id}\n\t lap not active, jump {distance_since_previous_tick}m\n"
+                    + f"\t\t lap length {lap.length} jumped to length {length}"
                 )
-                lap["active"] = True
-                lap["end"] = now
-                lap["length"] = length
-                lap["time"] = lap_time
+                lap.state = LapState.INACTIVE
+                return
+
+            # FIXME mark not active if we cut the track
+
+            if lap_time < lap.time:
+                logging.info(
+                    f"{self.session_id}\n\t stop measuring time at {lap_time}s for {lap.time}s / {length}m"
+                )
+                lap.state = LapState.INACTIVE
             else:
-                if (now - lap["inactive_log_time"]).seconds > 120:
-                    lap["inactive_log_time"] = now
-                    logging.info(
-                        f"{self.session_id}\n\t lap not active, time {lap_time} > lap.time {lap['time']}"
-                    )
+                lap.end = now
+                lap.length = length
+                lap.time = lap_time
+        elif state == LapState.WAITING and (lap_time < lap.time or lap_time == 0):
+            # start measuring time if we're past the threshold and the time started
+            #  some games have a delay on CurrentLapTime
+            logging.info(
+                f"{self.session_id}\n\t start measuring time at lap.time {lap.time} / time {lap_time}"
+            )
+            lap.state = LapState.MEASURING
+            lap.end = now
+            lap.length = length
+            lap.time = lap_time
+        elif (now - self.inactive_log_time).seconds > 120:
+            self.inactive_log_time = now
+            logging.info(
+                f"{self.session_id}\n\t lap not active, time {lap_time} > lap.time {lap.time}"
+            )
+
+    def start_lap(self, now, length, lap_time, current_lap, threshold, previous_length):
+        # if time is less than 5 seconds, lap is active
+        state = LapState.MEASURING if lap_time < 5 else LapState.WAITING
+        self.new_lap(now, number=current_lap, length=length, time=lap_time, state=state)
+        self.inactive_log_time = now
+        logging.info(
+            f"{self.session_id}\n\t new lap length {length} < threshold {threshold}"
+            + f" and < previous lap length {previous_length}, state: {state.name}, time: {lap_time}"
+        )
@@ -1,14 +1,23 @@
+import datetime
 import threading
 import logging
 import time
-from telemetry.models import Game, Driver, SessionType, Session
+from queue import Empty
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Greatest
+from telemetry.cache import identity_cache
+from telemetry.models import Game, Driver, SessionType, Car, Track, Session, Lap
+
+from .session import LAP_FINISHED
 
 
 class SessionSaver:
-    def __init__(self, firehose, debug=False):
+    def __init__(self, firehose, debug=False, journal=None):
         self.firehose = firehose
         self.sleep_time = 10
         self.debug = debug
+        self.journal = journal
 
         self._stop_event = threading.Event()
 
@@ -19,104 +28,298 @@ class SessionSaver:
         return self._stop_event.is_set()
 
     def save_sessions(self):
+        """Save sessions and laps as soon as the firehose emits their events.
+
+        Every sleep_time seconds all sessions are scanned as a safety net.
+        """
+        events = self.firehose.enable_events()
+        next_scan = time.monotonic() + self.sleep_time
         while True and not self.stopped():
-            time.sleep(self.sleep_time)
-            session_ids = list(self.firehose.sessions.keys())
-            for session_id in session_ids:
-                session = self.firehose.sessions.get(session_id)
-
-                # save session to database
-                if not session.record:
-                    try:
-                        session.driver, created = Driver.objects.get_or_create(
-                            name=session.driver
-                        )
-                        session.game, created = Game.objects.get_or_create(
-                            name=session.game_name
-                        )
-                        (
-                            session.session_type,
-                            created,
-                        ) = SessionType.objects.get_or_create(type=session.session_type)
-                        session.car, created = session.game.cars.get_or_create(
-                            name=session.car
+            timeout = min(1, max(0, next_scan - time.monotonic()))
+            try:
+                batch = [events.get(timeout=timeout)]
+            except Empty:
+                batch = []
+            # drain everything that is pending to save it in one batch
+            while batch:
+                try:
+                    batch.append(events.get_nowait())
+                except Empty:
+                    break
+            if batch:
+                self.save_events(batch)
+
+            if time.monotonic() >= next_scan:
+                self.save_cycle()
+                next_scan = time.monotonic() + self.sleep_time
+
+    def save_events(self, events):
+        sessions = {}
+        laps = []
+        for event, session, lap in events:
+            if session.id not in sessions:
+                sessions[session.id] = session
+                if not session.record and not self.save_session(session):
+                    continue
+            if self.debug or not session.record:
+                continue
+            if event == LAP_FINISHED and not lap.saved:
+                laps.append((session, lap))
+
+        if laps:
+            self.save_laps(laps)
+
+    def save_cycle(self):
+        if self.journal:
+            self.replay_journal()
+
+        laps = []
+        session_ids = list(self.firehose.sessions.keys())
+        for session_id in session_ids:
+            session = self.firehose.sessions.get(session_id)
+            if session is None:
+                # the session was evicted in the meantime
+                continue
+
+            # save session to database
+            if not session.record and not self.save_session(session):
+                continue
+
+            if self.debug:
+                continue
+
+            for lap in session.laps:
+                if lap.finished and not lap.saved:
+                    laps.append((session, lap))
+
+        # the saved laps are pruned by the firehose, see Firehose.clear_sessions
+        if laps:
+            self.save_laps(laps)
+
+    def save_session(self, session):
+        try:
+            session.driver, created = identity_cache.get_or_create(
+                Driver, name=session.driver
+            )
+            session.game, created = identity_cache.get_or_create(
+                Game, name=session.game_name
+            )
+            (
+                session.session_type,
+                created,
+            ) = identity_cache.get_or_create(SessionType, type=session.session_type)
+            session.car, created = identity_cache.get_or_create(
+                Car, game=session.game, name=session.car
+            )
+            session.track, created = identity_cache.get_or_create(
+                Track, game=session.game, name=session.track
+            )
+            if self.debug:
+                session.record = Session(
+                    driver=session.driver,
+                    session_id=session.session_id,
+                    session_type=session.session_type,
+                    game=session.game,
+                )
+            else:
+                (
+                    session.record,
+                    created,
+                ) = session.driver.sessions.get_or_create(
+                    session_id=session.session_id,
+                    session_type=session.session_type,
+                    game=session.game,
+                    defaults={"start": session.start, "end": session.end},
+                )
+        except Exception as e:
+            # TODO add error to session to expire
+            logging.error(f"Error saving session {session.id}: {e}")
+            return False
+        return True
+
+    def save_laps(self, laps):
+        """Save the finished laps of all sessions in one transaction.
+
+        The laps are written to the journal first, if there is one, and
+        acknowledged once they are committed to the database.
+        """
+        lap_records = []
+        seqs = []
+        session_ends = {}
+        tracks = {}
+        track_lengths = {}
+        for session, lap in laps:
+            lap.saved = True  # mark lap as saved, the firehose prunes it from memory
+
+            # check if lap length is within 98% of the track length
+            track = session.track
+            track_length = track_lengths.get(track.pk, track.length)
+            if lap.length > track_length * 0.98:
+                lap_records.append(
+                    Lap(
+                        session=session.record,
+                        number=lap.number,
+                        car=session.car,
+                        track=track,
+                        start=lap.start,
+                        end=lap.end,
+                        length=lap.length,
+                        valid=lap.valid,
+                        time=lap.time,
+                    )
+                )
+                session_ends[session.record.pk] = (session.record, session.end)
+                if self.journal:
+                    seqs.append(self.journal.append(self.journal_record(session, lap)))
+            else:
+                lstring = f"{lap.number}: {lap.time}s {lap.length}m"
+                logging.info(
+                    f"Discard lap {lstring} for session {session.id} - track length {track_length}m"
+                )
+
+            lap_length = int(lap.length)
+            if lap_length > track_length:
+                logging.info(
+                    f"updating {track.name} length from {track_length} to {lap_length}"
+                )
+                tracks[track.pk] = track
+                track_lengths[track.pk] = lap_length
+
+        if self.journal:
+            self.journal.sync()
+
+        if self.persist(lap_records, session_ends, tracks, track_lengths):
+            if self.journal:
+                self.journal.ack(seqs)
+
+    def persist(self, lap_records, session_ends, tracks, track_lengths):
+        """Insert the laps and update session ends and track lengths.
+
+        The laps are inserted with one bulk insert, the session end and the
+        track length are updated with one conditional UPDATE each.
+        """
+        try:
+            with transaction.atomic():
+                Lap.objects.bulk_create(lap_records, ignore_conflicts=True)
+                if session_ends:
+                    Session.objects.filter(pk__in=session_ends.keys()).update(
+                        end=self.greatest(
+                            "end",
+                            {pk: end for pk, (record, end) in session_ends.items()},
+                            models.DateTimeField(),
                         )
-                        session.track, created = session.game.tracks.get_or_create(
-                            name=session.track
+                    )
+                if track_lengths:
+                    Track.objects.filter(pk__in=track_lengths.keys()).update(
+                        length=self.greatest(
+                            "length", track_lengths, models.IntegerField()
                         )
-                        if self.debug:
-                            session.record = Session(
-                                driver=session.driver,
-                                session_id=session.session_id,
-                                session_type=session.session_type,
-                                game=session.game,
-                            )
-                        else:
-                            (
-                                session.record,
-                                created,
-                            ) = session.driver.sessions.get_or_create(
-                                session_id=session.session_id,
-                                session_type=session.session_type,
-                                game=session.game,
-                                defaults={"start": session.start, "end": session.end},
-                            )
-                    except Exception as e:
-                        # TODO add error to session to expire
-                        logging.error(f"Error saving session {session_id}: {e}")
-                        continue
-
-                if self.debug:
-                    continue
+                    )
+        except Exception as e:
+            logging.error(f"Error saving {len(lap_records)} laps: {e}")
+            return False
+
+        for lap_record in lap_records:
+            logging.info(f"Saving lap {lap_record} for session {lap_record.session}")
+        for record, end in session_ends.values():
+            record.end = max(record.end, end)
+        for pk, track in tracks.items():
+            track.length = max(track.length, track_lengths[pk])
+        return True
+
+    def journal_record(self, session, lap):
+        return {
+            "driver": str(session.driver),
+            "session_id": session.session_id,
+            "session_type": str(session.session_type),
+            "game": str(session.game),
+            "car": str(session.car),
+            "track": str(session.track),
+            "session_start": session.start.isoformat(),
+            "session_end": session.end.isoformat(),
+            "number": lap.number,
+            "start": lap.start.isoformat(),
+            "end": lap.end.isoformat(),
+            "length": lap.length,
+            "valid": lap.valid,
+            "time": lap.time,
+        }
+
+    def replay_journal(self):
+        """Save the laps of the journal which are not acknowledged yet."""
+        pending = self.journal.pending()
+        if not pending:
+            return
+
+        lap_records = []
+        session_ends = {}
+        tracks = {}
+        track_lengths = {}
+        try:
+            for seq, r in pending:
+                driver, created = identity_cache.get_or_create(Driver, name=r["driver"])
+                game, created = identity_cache.get_or_create(Game, name=r["game"])
+                session_type, created = identity_cache.get_or_create(
+                    SessionType, type=r["session_type"]
+                )
+                car, created = identity_cache.get_or_create(
+                    Car, game=game, name=r["car"]
+                )
+                track, created = identity_cache.get_or_create(
+                    Track, game=game, name=r["track"]
+                )
+                session_end = datetime.datetime.fromisoformat(r["session_end"])
+                record, created = driver.sessions.get_or_create(
+                    session_id=r["session_id"],
+                    session_type=session_type,
+                    game=game,
+                    defaults={
+                        "start": datetime.datetime.fromisoformat(r["session_start"]),
+                        "end": session_end,
+                    },
+                )
+                lap_records.append(
+                    Lap(
+                        session=record,
+                        number=r["number"],
+                        car=car,
+                        track=track,
+                        start=datetime.datetime.fromisoformat(r["start"]),
+                        end=datetime.datetime.fromisoformat(r["end"]),
+                        length=r["length"],
+                        valid=r["valid"],
+                        time=r["time"],
+                    )
+                )
+                if record.pk in session_ends:
+                    session_end = max(session_end, session_ends[record.pk][1])
+                session_ends[record.pk] = (record, session_end)
+                lap_length = int(r["length"])
+                if lap_length > track_lengths.get(track.pk, track.length):
+                    tracks[track.pk] = track
+                    track_lengths[track.pk] = lap_length
+        except Exception as e:
+            logging.error(f"Error replaying lap journal: {e}")
+            return
+
+        if self.persist(lap_records, session_ends, tracks, track_lengths):
+            self.journal.ack([seq for seq, r in pending])
+            logging.info(f"replayed {len(pending)} laps from the lap journal")
 
-                # iterate over laps with index
-                for lap in session.laps:
-                    if (
-                        session.record
-                        and lap["finished"]
-                        and not lap.get("delete", False)
-                    ):
-                        # check if lap length is within 98% of the track length
-                        track = session.track
-                        track_length = track.length
-                        lap["delete"] = True  # mark lap for deletion
-
-                        if lap["length"] > track_length * 0.98:
-                            try:
-                                lap_record = session.record.laps.create(
-                                    number=lap["number"],
-                                    car=session.car,
-                                    track=track,
-                                    start=lap["start"],
-                                    end=lap["end"],
-                                    length=lap["length"],
-                                    valid=lap["valid"],
-                                    time=lap["time"],
-                                )
-                                logging.info(
-                                    f"Saving lap {lap_record} for session {session_id}"
-                                )
-                                session.record.end = session.end
-                                session.record.save_dirty_fields()
-                            except Exception as e:
-                                logging.error(f"Error saving lap {lap['number']}: {e}")
-                        else:
-                            lstring = (
-                                f"{lap['number']}: {lap['time']}s {lap['length']}m"
-                            )
-                            logging.info(
-                                f"Discard lap {lstring} for session {session_id} - track length {track_length}m"
-                            )
-
-                        lap_length = int(lap["length"])
-                        if lap_length > track.length:
-                            track.refresh_from_db()
-                            if lap_length > track.length:
-                                logging.info(
-                                    f"updating {track.name} length from {track.length} to {lap_length}"
-                                )
-                                track.length = lap_length
-                                track.save()
+    @staticmethod
+    def greatest(field, values, output_field):
+        """Set field of every row to the maximum of its value and values[pk]."""
+        whens = [When(pk=pk, then=Value(value)) for pk, value in values.items()]
+        return Greatest(
+            field, Case(*whens, default=F(field)), output_field=output_field
+        )
 
     def run(self):
-        self.save_sessions()
+        identity_cache.preload()
+        if self.journal:
+            self.replay_journal()
+        try:
+            self.save_sessions()
+        finally:
+            if self.journal:
+                self.journal.close()
@@ -0,0 +1,162 @@
+import bisect
+import hashlib
+import json
+import logging
+import threading
+
+
+class HashRing:
+    """Consistent hash ring mapping keys to nodes.
+
+    Every node is placed on the ring `replicas` times, so adding or removing a
+    node only moves the keys of that node.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._ring = []
+        self._nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    @property
+    def nodes(self):
+        return set(self._nodes.keys())
+
+    def add(self, node):
+        if node in self._nodes:
+            return
+        points = [self._hash(f"{node}#{i}") for i in range(self.replicas)]
+        self._nodes[node] = points
+        for point in points:
+            bisect.insort(self._ring, (point, node))
+
+    def remove(self, node):
+        if node not in self._nodes:
+            return
+        del self._nodes[node]
+        self._ring = [(point, n) for point, n in self._ring if n != node]
+
+    def node_for(self, key):
+        if not self._ring:
+            return None
+        idx = bisect.bisect(self._ring, (self._hash(key),))
+        if idx == len(self._ring):
+            idx = 0
+        return self._ring[idx][1]
+
+
+class ShardCoordinator:
+    """Split the sessions between several firehose workers.
+
+    All workers subscribe to the whole telemetry stream, but each one only
+    processes the topics of the drivers it owns on the consistent hash ring.
+    Workers announce themselves with a retained message on the members topic,
+    the broker clears it via the last will if a worker dies. When the
+    membership changes, every worker hands the sessions it no longer owns over
+    to their new owner on the handover topic.
+
+    Args:
+        firehose (Firehose): the firehose owning the sessions
+        member_id (str): unique id of this worker, e.g. the pod name
+    """
+
+    MEMBERS_TOPIC = "pitcrew/firehose/members"
+    HANDOVER_TOPIC = "pitcrew/firehose/handover"
+
+    def __init__(self, firehose, member_id):
+        self.firehose = firehose
+        self.member_id = member_id
+        self.ring = HashRing([member_id])
+        self.left = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def shard_key(topic):
+        # crewchief/<driver>/<session>/<game>/<track>/<car>/<session_type>
+        frags = topic.split("/")
+        if frags[0] == "replay":
+            frags = frags[1:]
+        if len(frags) > 1:
+            return frags[1]
+        return topic
+
+    def setup(self, mqttc):
+        """Register the callbacks and the last will, call before connecting."""
+        mqttc.will_set(f"{self.MEMBERS_TOPIC}/{self.member_id}", None, 1, True)
+        mqttc.message_callback_add(f"{self.MEMBERS_TOPIC}/+", self.on_member)
+        mqttc.message_callback_add(
+            f"{self.HANDOVER_TOPIC}/{self.member_id}", self.on_handover
+        )
+
+    def on_connect(self, mqttc):
+        mqttc.subscribe(f"{self.MEMBERS_TOPIC}/+", 1)
+        mqttc.subscribe(f"{self.HANDOVER_TOPIC}/{self.member_id}", 1)
+        mqttc.publish(f"{self.MEMBERS_TOPIC}/{self.member_id}", "1", 1, True)
+
+    def owns(self, topic):
+        # not cached, that would keep an entry for every driver ever seen
+        return self.ring.node_for(self.shard_key(topic)) == self.member_id
+
+    def on_member(self, mqttc, obj, msg):
+        member_id = msg.topic.split("/")[-1]
+        if member_id == self.member_id:
+            return
+        with self._lock:
+            if msg.payload:
+                if member_id in self.ring.nodes:
+                    return
+                logging.info(f"firehose member {member_id} joined")
+                self.ring.add(member_id)
+            else:
+                if member_id not in self.ring.nodes:
+                    return
+                logging.info(f"firehose member {member_id} left")
+                self.ring.remove(member_id)
+            self.rebalance(mqttc)
+
+    def rebalance(self, mqttc):
+        """Hand over all sessions which are owned by another member now.
+
+        The handover runs on the worker of the session after the messages
+        queued for it, new messages of the topic are not queued anymore.
+        """
+        for topic in list(self.firehose.sessions):
+            if self.left or not self.owns(topic):
+                owner = self.ring.node_for(self.shard_key(topic))
+                self.firehose.run_in_order(topic, self.handover, mqttc, owner, topic)
+
+    def handover(self, mqttc, owner, topic):
+        session = self.firehose.sessions.get(topic)
+        if session is None:
+            return
+        self.firehose.delete_session(topic)
+        if not owner or owner == self.member_id:
+            return
+        logging.debug(f"handing over {session.id} to {owner}")
+        payload = json.dumps(session.to_dict())
+        mqttc.publish(f"{self.HANDOVER_TOPIC}/{owner}", payload, 1)
+
+    def on_handover(self, mqttc, obj, msg):
+        try:
+            state = json.loads(msg.payload)
+        except Exception as e:
+            logging.error(f"Error decoding handover: {e}")
+            return
+        logging.debug(f"taking over {state['id']}")
+        self.firehose.run_in_order(state["id"], self.firehose.adopt_session, state)
+
+    def leave(self, mqttc):
+        """Leave the ring and hand over all sessions to the remaining members."""
+        with self._lock:
+            if self.left:
+                return
+            self.left = True
+            self.ring.remove(self.member_id)
+            self.rebalance(mqttc)
+        mqttc.publish(f"{self.MEMBERS_TOPIC}/{self.member_id}", None, 1, True)
+        logging.info(f"firehose member {self.member_id} left the ring")
@@ -0,0 +1,48 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import fast_lap_cache, identity_cache
+from .models import (
+    Car,
+    Coach,
+    Driver,
+    FastLap,
+    FastLapSegment,
+    Game,
+    SessionType,
+    Track,
+)
+from .notify import COACH_CHANNEL, notifier
+
+
+@receiver(post_save, sender=Driver)
+@receiver(post_save, sender=Game)
+@receiver(post_save, sender=SessionType)
+@receiver(post_save, sender=Car)
+@receiver(post_save, sender=Track)
+@receiver(post_delete, sender=Driver)
+@receiver(post_delete, sender=Game)
+@receiver(post_delete, sender=SessionType)
+@receiver(post_delete, sender=Car)
+@receiver(post_delete, sender=Track)
+def invalidate_identity_cache(sender, instance, **kwargs):
+    identity_cache.invalidate(instance)
+
+
+@receiver(post_save, sender=Coach)
+@receiver(post_delete, sender=Coach)
+def notify_coach_changed(sender, instance, **kwargs):
+    # the coach watcher of the pitcrew reloads the coach of this driver
+    notifier.notify(COACH_CHANNEL, str(instance.pk))
+
+
+@receiver(post_save, sender=FastLap)
+@receiver(post_delete, sender=FastLap)
+def invalidate_fast_lap_cache(sender, instance, **kwargs):
+    fast_lap_cache.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=FastLapSegment)
+@receiver(post_delete, sender=FastLapSegment)
+def invalidate_fast_lap_segment(sender, instance, **kwargs):
+    fast_lap_cache.invalidate(instance.fast_lap_id)
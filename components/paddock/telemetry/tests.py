@@ -1,3 +1,170 @@
-# from django.test import TestCase
+import os
+import random
+import tempfile
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from telemetry.pitcrew.eviction import TimerWheel
+from telemetry.pitcrew.journal import LapJournal
+from telemetry.pitcrew.message_cursor import MessageCursor
+from telemetry.pitcrew.segment_stats import P2Quantile
+
+
+class MessageCursorTest(SimpleTestCase):
+    def drive(self, cursor, distances, speed=0.0):
+        fired = []
+        for distance in distances:
+            fired.extend(cursor.due(distance, speed))
+        return fired
+
+    def test_message_in_last_tick_gap_before_the_line(self):
+        cursor = MessageCursor({500: 0, 999: 0}, length=1000)
+        # 13 meter ticks, the last one of the lap at 988, the next at 1
+        distances = [(tick * 13) % 1000 for tick in range(155)]
+        self.assertEqual(self.drive(cursor, distances), [500, 999, 500, 999])
+
+    def test_message_at_the_start_of_the_lap(self):
+        cursor = MessageCursor({5: 0, 500: 0}, length=1000)
+        fired = self.drive(cursor, [0, 13, 500, 990, 12, 25])
+        self.assertEqual(fired, [5, 500, 5])
+
+    def test_no_message_skipped_with_dropped_ticks(self):
+        cursor = MessageCursor({100: 0, 110: 0, 120: 0}, length=1000)
+        self.assertEqual(self.drive(cursor, [90, 130]), [100, 110, 120])
+
+    def test_lead_time(self):
+        cursor = MessageCursor({100: 0.5}, length=1000)
+        # 50 m/s with 0.5 seconds lead time fires 25 meters early
+        self.assertEqual(self.drive(cursor, [70], speed=50), [])
+        self.assertEqual(self.drive(cursor, [74], speed=50), [100])
+
+    def test_messages_left_over_stay_due(self):
+        cursor = MessageCursor({100: 0, 110: 0}, length=1000)
+        self.assertEqual(self.drive(cursor, [90]), [])
+        for at in cursor.due(120):
+            self.assertEqual(at, 100)
+            break
+        self.assertEqual(self.drive(cursor, [121]), [110])
+
+    def test_reset_to_the_pits_skips_the_passed_messages(self):
+        cursor = MessageCursor({100: 0, 700: 0, 900: 0}, length=1000)
+        self.assertEqual(self.drive(cursor, [50, 110, 800, 200, 300]), [100, 700])
+
+
+class LapJournalTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def segments(self):
+        return sorted(
+            name for name in os.listdir(self.directory) if name.endswith(".log")
+        )
+
+    def test_unacked_records_are_recovered(self):
+        journal = LapJournal(self.directory)
+        for lap in ["a", "b", "c"]:
+            journal.append({"lap": lap})
+        journal.sync()
+        journal.ack([1])
+        journal.close()
+
+        journal = LapJournal(self.directory)
+        self.assertEqual(journal.pending(), [(2, {"lap": "b"}), (3, {"lap": "c"})])
+        self.assertEqual(journal.next_seq, 4)
+        journal.close()
+
+    def test_checkpoint_stays_below_unacked_records(self):
+        journal = LapJournal(self.directory)
+        for lap in ["a", "b", "c"]:
+            journal.append({"lap": lap})
+        journal.ack([2, 3])
+        self.assertEqual(journal.checkpoint, 0)
+        journal.ack([1])
+        self.assertEqual(journal.checkpoint, 3)
+        journal.close()
+
+        self.assertEqual(LapJournal(self.directory).pending(), [])
+
+    def test_compact_keeps_the_open_segment(self):
+        journal = LapJournal(self.directory, segment_size=2)
+        seqs = [journal.append({"lap": lap}) for lap in range(5)]
+        self.assertEqual(len(self.segments()), 3)
+        journal.ack(seqs)
+        self.assertEqual(self.segments(), ["000000000005.log"])
+        self.assertEqual(journal.append({"lap": 5}), 6)
+        journal.close()
+
+        self.assertEqual(LapJournal(self.directory).pending(), [(6, {"lap": 5})])
+
+    def test_torn_last_line_is_skipped(self):
+        journal = LapJournal(self.directory)
+        journal.append({"lap": "a"})
+        journal.append({"lap": "b"})
+        journal.close()
+        with open(os.path.join(self.directory, self.segments()[-1]), "a") as f:
+            f.write('{"seq": 3, "rec')
+
+        with self.assertLogs(level="WARNING"):
+            journal = LapJournal(self.directory)
+        self.assertEqual(journal.pending(), [(1, {"lap": "a"}), (2, {"lap": "b"})])
+        self.assertEqual(journal.next_seq, 3)
+        journal.close()
+
+
+class TimerWheelTest(SimpleTestCase):
+    def test_keys_expire_at_their_deadline(self):
+        wheel = TimerWheel(resolution=1.0, slots=8)
+        wheel.schedule("a", 5)
+        wheel.schedule("b", 7)
+        self.assertEqual(wheel.advance(0), [])
+        self.assertEqual(wheel.advance(4.5), [])
+        self.assertEqual(wheel.advance(5), ["a"])
+        self.assertNotIn("a", wheel)
+        self.assertEqual(len(wheel), 1)
+
+    def test_rescheduled_and_cancelled_keys(self):
+        wheel = TimerWheel(resolution=1.0, slots=8)
+        wheel.schedule("a", 3)
+        wheel.schedule("b", 3)
+        wheel.schedule("a", 6)
+        wheel.cancel("b")
+        self.assertEqual(wheel.advance(3), [])
+        self.assertEqual(wheel.advance(6), ["a"])
+
+    def test_deadline_beyond_one_revolution(self):
+        wheel = TimerWheel(resolution=1.0, slots=8)
+        wheel.advance(0)
+        wheel.schedule("a", 30)
+        # the slot of the deadline is passed twice before it is due
+        self.assertEqual(wheel.advance(10), [])
+        self.assertEqual(wheel.advance(22), [])
+        self.assertEqual(wheel.advance(100), ["a"])
+
+
+class P2QuantileTest(SimpleTestCase):
+    def test_few_values(self):
+        quantile = P2Quantile(0.5)
+        self.assertIsNone(quantile.value)
+        for value in [30, 10, 20]:
+            quantile.add(value)
+        self.assertEqual(quantile.value, 20)
+
+    def test_median_estimate(self):
+        values = list(range(1, 1002))
+        random.Random(7).shuffle(values)
+        quantile = P2Quantile(0.5)
+        for value in values:
+            quantile.add(value)
+        self.assertAlmostEqual(quantile.value, 501, delta=25)
+
+    def test_quantile_estimate(self):
+        values = list(range(1, 1002))
+        random.Random(7).shuffle(values)
+        quantile = P2Quantile(0.9)
+        for value in values:
+            quantile.add(value)
+        self.assertAlmostEqual(quantile.value, 901, delta=25)